@@ -13,24 +13,72 @@ Written by Edward K. Ream.
 """
 #@+<< imports >>
 #@+node:ekr.20160318141204.2: **  << imports >> (make_stub_files.py)
-import argparse
+# Import only the modules that making stubs requires.
+# Other modules are imported when needed.
 import ast
 from ast import AST as Node
-from collections import OrderedDict
-import configparser
+import contextlib
+import functools
 import glob
 import io
 import os
-import pdb
 import re
 import sys
-import textwrap
 import time
-from typing import Any, Dict, List, Optional, Tuple
-import unittest
+from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 #@-<< imports >>
+
+__version__ = '1.0'
+
 #@+others
 #@+node:ekr.20210805085843.1: ** top-level functions
+#@+node:ekr.20261017101001.1: *3* function: atomic_write
+def atomic_write(fn: str, s: Union[bytes, str], encoding: str=None) -> None:
+    """
+    Write s, a string or bytes, to fn atomically: write a temp file in fn's
+    directory, then rename it. Readers of fn never see a partially written
+    file.
+    """
+    temp_fn = '%s.%s.tmp' % (fn, os.getpid())
+    try:
+        if isinstance(s, bytes):
+            f = open(temp_fn, 'wb')
+        else:
+            f = open(temp_fn, 'w', encoding=encoding)
+        with f:
+            f.write(s)
+        os.replace(temp_fn, fn)
+    except BaseException:
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        raise
+#@+node:ekr.20261017090102.1: *3* function: call_captured
+def call_captured(function: Callable[[str], Any], fn: str) -> Tuple[str, str, float, Optional[str], Any]:
+    """
+    Call function(fn), capturing everything it prints.
+
+    Return (fn, output, elapsed, error, result), where error is a formatted
+    traceback or None, and result is the result of function(fn).
+    """
+    f = io.StringIO()
+    error, result = None, None
+    t1 = time.perf_counter()
+    with contextlib.redirect_stdout(f):
+        try:
+            result = function(fn)
+        except Exception:
+            import traceback
+            error = traceback.format_exc()
+    return fn, f.getvalue(), time.perf_counter() - t1, error, result
+#@+node:ekr.20261017094001.1: *3* function: changed_files
+def changed_files(old: Dict[str, float], new: Dict[str, float]) -> List[str]:
+    """
+    old and new map file names to modification times.
+
+    Return the sorted list of the files in new that are not in old or whose
+    modification times differ.
+    """
+    return sorted(fn for fn, mtime in new.items() if old.get(fn) != mtime)
 #@+node:ekr.20160318141204.8: *3* function: dump
 def dump(title: str, s: str=None) -> None:  # pragma: no cover
     if s:
@@ -56,14 +104,173 @@ def dump_list(title: str, aList: List[Any]) -> None:  # pragma: no cover
 def finalize(fn: str) -> str:
     """Finalize and regularize a filename."""
     return os.path.normpath(os.path.abspath(os.path.expanduser(fn)))
-#@+node:ekr.20160318141204.4: *3* function: is_known_type
+#@+node:ekr.20261017101002.1: *3* function: find_source_files
+# The default fnmatch patterns of the files and directories that
+# --recursive skips. The [Global] exclude option adds more patterns.
+default_excludes = (
+    '.*',  # .git, .tox, .venv, .mypy_cache, etc.
+    '__pycache__', '*.egg-info', 'build', 'dist', 'node_modules',
+    'site-packages', 'venv',
+)
+
+def find_source_files(
+    root: str,
+    excludes: Iterable[str]=default_excludes,
+    extensions: Tuple[str, ...]=('.py',),
+) -> List[str]:
+    """
+    Return the sorted list of the files in root's tree whose extensions are
+    in extensions, using a single os.scandir traversal.
+
+    Skip the files and directories whose names, or whose paths relative to
+    root, match any of the fnmatch patterns in excludes. Don't follow
+    symbolic links to directories.
+    """
+    import fnmatch
+    patterns = '|'.join(fnmatch.translate(z) for z in excludes)
+    exclude = re.compile(patterns).match if patterns else None
+    result: List[str] = []
+    stack = [(root, '')]  # (path, path relative to root, with a trailing '/')
+    while stack:
+        path, prefix = stack.pop()
+        try:
+            entries = list(os.scandir(path))
+        except OSError:  # pragma: no cover
+            continue
+        for entry in entries:
+            name = entry.name
+            if exclude and (exclude(name) or exclude(prefix + name)):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, prefix + name + '/'))
+                elif name.endswith(extensions) and entry.is_file():
+                    result.append(entry.path)
+            except OSError:  # pragma: no cover
+                pass
+    return sorted(result)
+#@+node:ekr.20160318141204.4: *3* function: is_known_type & helper
+# Types that may be followed by (*).
+_known_types = frozenset((
+    '', 'None',  # Tricky.
+    'complex', 'float', 'int', 'long', 'number',
+    'dict', 'list', 'tuple',
+    'bool', 'bytes', 'str', 'unicode',
+))
+
+# Names that may be followed by [*].
+_known_names = frozenset((
+    # Pep 484: https://www.python.org/dev/peps/pep-0484/
+    # typing module: https://docs.python.org/3/library/typing.html
+    'Any', 'Dict', 'List', 'Optional', 'Tuple', 'Union',
+    # Not generated by this program, but could arise from patterns.
+    'AbstractSet', 'AnyMeta', 'AnyStr',
+    'BinaryIO', 'ByteString',
+    'Callable', 'CallableMeta', 'Container',
+    'Final', 'Generic', 'GenericMeta', 'Hashable',
+    'IO', 'ItemsView', 'Iterable', 'Iterator',
+    'KT', 'KeysView',
+    'Mapping', 'MappingView', 'Match',
+    'MutableMapping', 'MutableSequence', 'MutableSet',
+    'NamedTuple', 'OptionalMeta',
+    # 'POSIX', 'PY2', 'PY3',
+    'Pattern', 'Reversible',
+    'Sequence', 'Set', 'Sized',
+    'SupportsAbs', 'SupportsFloat', 'SupportsInt', 'SupportsRound',
+    'T', 'TextIO', 'TupleMeta', 'TypeVar', 'TypingMeta',
+    'Undefined', 'UnionMeta',
+    'VT', 'ValuesView', 'VarBinding',
+))
+
+@functools.lru_cache(maxsize=4096)
 def is_known_type(s: str) -> bool:
     """
     Return True if s is nothing but a single known type.
-    Recursively test inner types in square brackets.
+
+    It suits the methods of the ReduceTypes class *not* to test inside
+    inner brackets. This prevents unwanted Any types.
+
+    This function is equivalent to matching the patterns 'name(*)' for all
+    names in _known_types and 'name[*]' for all names in _known_names, but
+    it looks up the prefix of s and scans the brackets just once. The
+    results are memoized: most files contain just a few distinct types.
+    """
+    s = s.strip()
+    if s in _known_types or s in _known_names:
+        return True
+    i = s.find('(')
+    if i > 0 and s[:i] in _known_types and matching_delim(s, i) == len(s) - 1:
+        return True
+    if s.startswith('[') and s.endswith(']'):
+        inner = s[1:-1]
+        return is_known_type(inner) if inner else True
+    if s.startswith('(') and s.endswith(')'):
+        inner = s[1:-1]
+        return is_known_type(inner) if inner else True
+    if s.startswith('{') and s.endswith('}'):
+        return True
+    # Don't look inside brackets.
+    i = s.find('[')
+    return i > 0 and s[:i] in _known_names and matching_delim(s, i) == len(s) - 1
+
+def matching_delim(s: str, i: int) -> int:
+    """
+    s[i] is '(', '[' or '{'.
+    Return the index of the matching delim, ignoring other kinds of delims,
+    or -1 if there is no matching delim.
+    """
+    delim = s[i]
+    delim2 = ')]}'['([{'.index(delim)]
+    level = 0
+    for j in range(i, len(s)):
+        ch = s[j]
+        if ch == delim:
+            level += 1
+        elif ch == delim2:
+            level -= 1
+            if level == 0:
+                return j
+    return -1
+
+#@+node:ekr.20261017098005.1: *3* functions: generate_stub & generate_stubs
+# The library API.
+
+@functools.lru_cache(maxsize=8)
+def get_controller_for_config(config: str) -> "Controller":
+    """Return a Controller for config, the contents of a configuration file."""
+    controller = Controller()
+    controller.load_config(config)
+    return controller
+
+def generate_stub(source: str, config: Union[str, "Controller"]=None, name: str='<string>') -> str:
     """
-    return ReduceTypes().is_known_type(s)
+    Return the stubs for source, a string containing Python code.
 
+    config is the contents of a configuration file, or a Controller whose
+    patterns are already set, or None. Calls with the same config string
+    share one Controller, so the patterns are compiled only once.
+
+    name is the file name used in error messages. Nothing is read from or
+    written to the file system.
+    """
+    if not isinstance(config, Controller):
+        config = get_controller_for_config(config or '')
+    return config.make_stub_string(source, name)
+
+def generate_stubs(
+    sources: Iterable[Tuple[str, str]],
+    config: Union[str, "Controller"]=None,
+) -> Iterator[Tuple[str, str]]:
+    """
+    sources is an iterable of (name, source) pairs.
+
+    Yield (name, stubs) for each pair, using the same patterns for all.
+    See generate_stub.
+    """
+    if not isinstance(config, Controller):
+        config = get_controller_for_config(config or '')
+    for name, source in sources:
+        yield name, config.make_stub_string(source, name)
 #@+node:ekr.20160318141204.11: *3* function: main
 def main() -> None:  # pragma: no cover
     """
@@ -73,8 +280,62 @@ def main() -> None:  # pragma: no cover
     controller = Controller()
     controller.scan_command_line()
     controller.scan_options()
-    for fn in controller.files:
-        controller.make_stub_file(fn)
+    if controller.benchmark_flag:
+        import make_stub_files_benchmark
+        make_stub_files_benchmark.run_benchmark(controller.config_fn, controller.files)
+    elif controller.server_flag:
+        server = StubServer(controller)
+        if controller.socket_path:
+            server.serve_socket(controller.socket_path)
+        else:
+            server.serve_stdio()
+    elif controller.watch_flag:
+        controller.watch()
+    else:
+        controller.make_stub_files()
+#@+node:ekr.20261017090103.1: *3* function: map_files
+def map_files(
+    function: Callable[[str], Any],
+    files: List[str],
+    jobs: int,
+    initializer: Callable[..., None]=None,
+    initargs: Tuple=(),
+) -> Iterator[Tuple[str, str, float, Optional[str], Any]]:
+    """
+    Call function(fn) for every fn in files, using a pool of jobs processes.
+
+    function and initializer must be top-level functions, so that the
+    worker processes can unpickle them. initializer(*initargs) runs once in
+    each worker.
+
+    Yield the results of call_captured in the order of files, regardless of
+    the order in which the workers finish.
+    """
+    if jobs <= 1 or len(files) < 2:
+        # Don't start a pool: do the work in this process.
+        if initializer:
+            initializer(*initargs)
+        for fn in files:
+            yield call_captured(function, fn)
+        return
+    import concurrent.futures
+    chunksize = max(1, len(files) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=initializer, initargs=initargs,
+    ) as executor:
+        yield from executor.map(
+            functools.partial(call_captured, function), files, chunksize=chunksize)
+#@+node:ekr.20261017101011.1: *3* function: read_source
+def read_source(fn: str) -> bytes:
+    """
+    Return the contents of the Python source file fn, read once, as bytes.
+
+    Pass the bytes straight to ast.parse, which decodes them as PEP 263
+    specifies: using the encoding declaration or the utf-8 BOM if present,
+    and utf-8 otherwise.
+    """
+    with open(fn, 'rb') as f:
+        return f.read()
 #@+node:ekr.20160318141204.6: *3* function: reduce_types
 def reduce_types(aList: List[str], name: str=None, trace: bool=False) -> str:
     """
@@ -141,6 +402,28 @@ def op_name(node):  # pragma: no cover
 def truncate(s: str, n: int) -> str:
     """Return s truncated to n characters."""
     return s if len(s) <= n else s[: n - 3] + '...'
+#@+node:ekr.20261017090104.1: *3* functions: worker processes
+# These functions run in the worker processes created by map_files.
+
+g_controller: "Controller" = None  # The Controller in a worker process.
+
+def init_worker(controller: "Controller") -> None:
+    """Remember the Controller (and its patterns) in a worker process."""
+    global g_controller
+    g_controller = controller
+    if controller.profiler:
+        controller.profiler.install()
+
+def make_stub_file_in_worker(fn: str) -> Tuple[Optional[bool], Optional[Dict[str, List[float]]]]:
+    """
+    Make the stub for fn, using the worker's Controller.
+
+    Return (the result of make_stub_file, the profiler's stats for fn or None).
+    """
+    profiler = g_controller.profiler
+    with g_controller.profile_file(fn):
+        written = g_controller.make_stub_file(fn)
+    return written, profiler.files.pop(fn, None) if profiler else None
 #@+node:ekr.20160318141204.14: **  class AstFormatter
 class AstFormatter:
     """
@@ -151,6 +434,27 @@ class AstFormatter:
     # pylint: disable=consider-using-enumerate
 
     #@+others
+    #@+node:ekr.20261017101004.1: *3*  f.dispatch_dict
+    # Keys are ast node classes. Values are the do_* methods of the class.
+    dispatch_dict: Dict[type, Callable[[Any, Node], str]] = {}
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        """Give each subclass its own dispatch_dict."""
+        super().__init_subclass__(**kwargs)  # type:ignore
+        cls.make_dispatch_dict()
+
+    @classmethod
+    def make_dispatch_dict(cls) -> None:
+        """Set cls.dispatch_dict for all subclasses of ast.AST that exist now."""
+        d = {}
+        stack = [ast.AST]
+        while stack:
+            node_class = stack.pop()
+            stack.extend(node_class.__subclasses__())
+            method = getattr(cls, 'do_' + node_class.__name__, None)
+            if method:
+                d[node_class] = method
+        cls.dispatch_dict = d
     #@+node:ekr.20160318141204.15: *3*  f.Entries
 
     # Entries...
@@ -158,29 +462,102 @@ class AstFormatter:
     def format(self, node: Node) -> str:
         """Format the node (or list of nodes) and its descendants."""
         self.level = 0
-        val = self.visit(node)
+        try:
+            val = self.visit(node)
+        except RecursionError:
+            # Machine-generated code may contain very deep expressions.
+            val = self.format_iteratively(node)
         return val  # val is a string.
+    #@+node:ekr.20261017101005.1: *4* f.format_iteratively
+    # The classes of nodes whose formatting does not depend on self.level,
+    # unless they contain an ast.Lambda: do_Lambda indents its result.
+    memo_classes = (ast.expr, ast.keyword, ast.comprehension)
+
+    def format_iteratively(self, node: Node) -> str:
+        """
+        Format the node (or list of nodes) and its descendants, without
+        deep recursion, however deeply nested its expressions are.
+
+        Using an explicit stack, format all the expressions in node's tree
+        bottom-up, remembering the results. Each visitor then finds the
+        results for its operands, so no visit recurses more than a level.
+        The visitors themselves produce the output, so it is identical to
+        the output of self.visit.
+        """
+        # Traverse the tree, computing self.in_subscript for each node.
+        sets_in_subscript = self.dispatch_dict.get(ast.Subscript) is AstFormatter.do_Subscript
+        order: List[Tuple[Node, bool]] = []  # (node, in_subscript), in pre-order.
+        stack: List[Tuple[Any, bool]] = [(node, False)]
+        while stack:
+            z, in_subscript = stack.pop()
+            if isinstance(z, (list, tuple)):
+                stack.extend((z2, in_subscript) for z2 in reversed(z))
+                continue
+            if z is None:
+                continue
+            order.append((z, in_subscript))
+            if sets_in_subscript and isinstance(z, ast.Subscript):
+                in_subscript = True
+            stack.extend((z2, in_subscript) for z2 in ast.iter_child_nodes(z))
+        # Format the expressions bottom-up, children before parents.
+        memo: Dict[int, str] = {}
+        lambdas: Set[int] = set()  # The ids of lambdas and their ancestors.
+        instance_visit = vars(self).get('visit')  # StubFormatter.visit_memo, or None.
+        visit = self.visit
+
+        def visit_memo(node: Node) -> str:
+            s = memo.get(id(node))
+            return visit(node) if s is None else s
+
+        self.level = 0
+        self.visit = visit_memo  # type:ignore
+        try:
+            for z, in_subscript in reversed(order):
+                if isinstance(z, ast.Lambda) or any(
+                    id(z2) in lambdas for z2 in ast.iter_child_nodes(z)
+                ):
+                    lambdas.add(id(z))
+                elif isinstance(z, self.memo_classes):
+                    self.in_subscript = in_subscript
+                    memo[id(z)] = visit(z)
+            self.in_subscript = False
+            return visit(node)
+        finally:
+            if instance_visit:
+                self.visit = instance_visit  # type:ignore
+            else:
+                del self.visit
+            self.in_subscript = False
     #@+node:ekr.20160318141204.18: *4* f.visit
     def visit(self, node: Node) -> str:
         """Return the formatted version of an Ast node, or list of Ast nodes."""
+        method = self.dispatch_dict.get(node.__class__)
+        if method:
+            return method(self, node)
+        return self.visit_other(node)
+
+    def visit_other(self, node: Node) -> str:
+        """
+        Format a list of nodes, None, or a node that is not in
+        self.dispatch_dict.
+        """
         tag = 'AstFormatter.visit'
         name = node.__class__.__name__
-        ### g.trace(name) ###
         if isinstance(node, (list, tuple)):
             return ','.join([self.visit(z) for z in node])  # pragma: no cover (defensive)
         if node is None:
             return 'None'  # pragma: no cover
-        method_name = 'do_' + node.__class__.__name__
-        method = getattr(self, method_name, None)
-        if method:
+        method = getattr(self, 'do_' + name, None)
+        if method:  # pragma: no cover (defensive)
+            # A node class created after this class.
             s = method(node)
             assert isinstance(s, str), s.__class__.__name__
             return s
         # #13: *Never* ignore missing visitors!
         #      Insert an error comment directly into the output.
-        message = f"\n#{tag}: no visitor: do_{name}\n"  # pragma: no cover (defensive)
-        print(message, flush=True)  # pragma: no cover (defensive)
-        return message  # pragma: no cover (defensive)
+        message = f"\n#{tag}: no visitor: do_{name}\n"
+        print(message, flush=True)
+        return message
     #@+node:ekr.20160318141204.19: *3* f.Contexts
 
     # Contexts...
@@ -919,6 +1296,8 @@ class AstFormatter:
         if strict: assert name, self.kind(node)
         return name
     #@-others
+
+AstFormatter.make_dispatch_dict()
 #@+node:ekr.20160318141204.90: ** class AstArgFormatter (AstFormatter)
 class AstArgFormatter(AstFormatter):
     """
@@ -948,6 +1327,76 @@ class AstArgFormatter(AstFormatter):
         """This represents a string constant."""
         return 'str'
     #@-others
+#@+node:ekr.20261017093001.1: ** class CompiledPatterns
+class CompiledPatterns:
+    """
+    The patterns that StubFormatter.match_all applies to each kind of node,
+    compiled once by Controller.make_patterns_dict.
+
+    - node_patterns: Keys are names of ast node classes. Values are tuples
+      of the patterns for that class, followed by all regex patterns.
+    - regex: A single regex, the alternation of (almost) all regex patterns.
+      One scan of regex finds the first regex pattern that could match.
+    """
+    #@+others
+    #@+node:ekr.20261017093002.1: *3* compiled.ctor
+    def __init__(self) -> None:
+        """Ctor for the CompiledPatterns class."""
+        self.node_patterns: Dict[str, Tuple["Pattern", ...]] = {}
+        self.regex: Any = None
+        self.regex_patterns: Tuple["Pattern", ...] = ()
+        self.merged: Tuple[bool, ...] = ()  # True if regex_patterns[i] is part of self.regex.
+    #@+node:ekr.20261017093003.1: *3* compiled.compile
+    # Backreferences, named groups, conditionals and global flags can't be
+    # part of the alternation of all regex patterns.
+    unmergeable_pattern = re.compile(r'\\[1-9]|\(\?(?![:=!]|<[=!])')
+
+    def compile(self, patterns_dict: Dict[str, List["Pattern"]], regex_patterns: List["Pattern"]) -> None:
+        """Compile the patterns from Controller.make_patterns_dict."""
+        self.regex_patterns = tuple(regex_patterns)
+        self.node_patterns = {
+            name: tuple(aList) + self.regex_patterns
+                for name, aList in patterns_dict.items()
+        }
+        # Merge all mergeable regex patterns into one alternation.
+        self.merged = tuple(
+            not self.unmergeable_pattern.search(z.find_s) for z in self.regex_patterns)
+        groups = [
+            '(?P<p%s>%s)' % (i, z.find_s)
+                for i, z in enumerate(self.regex_patterns) if self.merged[i]
+        ]
+        self.regex = None
+        if groups:
+            try:
+                self.regex = re.compile('|'.join(groups))
+            except re.error:  # pragma: no cover (defensive)
+                self.merged = tuple(False for z in self.regex_patterns)
+    #@+node:ekr.20261017093004.1: *3* compiled.match
+    def match(self, name: str, s: str) -> Tuple[Optional["Pattern"], str]:
+        """
+        Apply the patterns for ast nodes of the given class name to s.
+
+        Return (pattern, new s) for the first pattern that matches all of s,
+        or (None, s).
+        """
+        patterns = self.node_patterns.get(name, self.regex_patterns)
+        if not patterns:
+            return None, s
+        # Use self.regex to skip merged regex patterns that can't match.
+        n = len(patterns) - len(self.regex_patterns)
+        first = 0
+        if self.regex:
+            m = self.regex.match(s)
+            first = n + int(m.lastgroup[1:]) if m else len(patterns)
+        merged = self.merged
+        for i, pattern in enumerate(patterns):
+            if i >= n and i < first and merged[i - n]:
+                continue
+            found, s2 = pattern.match(s)
+            if found:
+                return pattern, s2
+        return None, s
+    #@-others
 #@+node:ekr.20160318141204.125: ** class Controller
 class Controller:
     """
@@ -960,16 +1409,29 @@ class Controller:
         """Ctor for Controller class."""
         self.options: Dict[str, str] = {}
         # Ivars set on the command line...
+        self.benchmark_flag = False
+        self.cache_directory: str = None
         self.config_fn: str = None
         self.enable_coverage_tests = False
         self.enable_unit_tests = False
         self.files: List[str] = []
+        self.force_pyx = False
+        self.excludes: List[str] = list(default_excludes)  # For --recursive.
+        self.jobs = 0  # Number of worker processes. 0: don't use map_files.
+        self.memoize = False  # True: StubFormatter formats repeated expressions once.
+        self.profile_fn: str = None  # The file for --profile-json.
+        self.profiler: Optional["Profiler"] = None  # Created by --profile.
+        self.recursive = False
+        self.server_flag = False
+        self.socket_path: str = None  # The Unix domain socket for --server.
+        self.watch_flag = False
         # Ivars set in the config file...
         self.output_fn: str = None
         self.output_directory: str = None
         self.overwrite = False
         self.prefix_lines: List[str] = []
         self.silent = False
+        self.time_stamp_flag = True  # False: --no-time-stamp.
         self.trace_matches = False
         self.trace_patterns = False
         self.trace_reduce = False
@@ -977,79 +1439,333 @@ class Controller:
         self.update_flag = False
         self.verbose = False  # Trace config arguments.
         self.warn = False
+        # Other ivars...
+        self.cache: Optional["StubCache"] = None  # Created by get_cache.
+        self.config_s = ''  # The contents of the config file.
+        self.patterns_config_s = ''  # The config_s from which the patterns come.
+        self.config_parser: Any = None  # The parser property.
+        self.global_options: Dict[str, str] = {}  # The [Global] options of the config file.
+        self.directories: Dict[str, bool] = {}  # Cached results of is_directory.
+        self.file_patterns: List[str] = []  # The unexpanded globs of self.files.
+        self.source_roots: Dict[str, str] = {}
+            # Keys are files found by --recursive. Values are the directories
+            # whose trees contain them.
         # Pattern lists, set by config sections...
         self.section_names = ('Global', 'Def Name Patterns', 'General Patterns')
         self.def_patterns: List["Pattern"] = []  # [Def Name Patterns]
         self.general_patterns: List["Pattern"] = []  # [General Patterns]
+        self.compiled_patterns = CompiledPatterns()  # Compiled by make_patterns_dict.
         self.names_dict: Dict[str, str] = {}
         self.op_name_dict: Dict[str, List[str]] = self.make_op_name_dict()
         self.patterns_dict: Dict[str, List["Pattern"]] = {}
         self.regex_patterns: List[Any] = []
+    #@+node:ekr.20261017090105.1: *3* msf.__getstate__
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        Return the state to be pickled when sending this Controller to the
+        worker processes. The workers don't need the config parser: the
+        parser property recreates it if need be.
+        """
+        d = self.__dict__.copy()
+        d['config_parser'] = None
+        return d
     #@+node:ekr.20160318141204.128: *3* msf.make_stub_file
     directory_warning_given = False
 
-    def make_stub_file(self, fn: str) -> None:  # pragma: no cover
+    def make_stub_file(self, fn: str) -> Optional[bool]:  # pragma: no cover
         """
         Make a stub file in ~/stubs for all source files mentioned in the
         [Source Files] section of the configuration file.
+
+        Return True if the stub file was written, False if it already
+        contained the stubs, and None if there were errors.
         """
         global g_input_file_name
         extension = fn[fn.rfind('.'):]
         if not extension == '.py' and not (self.force_pyx and extension == '.pyx'):  
             print('not a python file', fn)
-            return
+            return None
         #
         # Read the input file.
-        if not os.path.exists(fn):
+        try:
+            s = read_source(fn)
+        except OSError:
             print('not found', fn)
-            return
+            return None
         # Set g_input_file_name for error messages.
         g_input_file_name = g.shortFileName(fn)  # type:ignore
-        try:
-            with open(fn, 'r') as f:
-                s = f.read()
-        except UnicodeDecodeError:
-            # Try utf-8 encoding.
-            with open(fn, 'r', encoding='utf-8') as f:
-                s = f.read()
         #
         # Compute the output file name.
         if self.output_directory:
-            if not os.path.exists(self.output_directory):
+            if not self.is_directory(self.output_directory):
                 if not self.directory_warning_given:
                     self.directory_warning_given = True
                     print('output directory not found:', repr(self.output_directory))
-                return
-            base_fn = os.path.basename(fn)
-            out_fn = os.path.join(self.output_directory, base_fn)
+                return None
+            root = self.source_roots.get(fn)
+            if root:
+                # Mirror the layout of root's tree in the output directory.
+                out_fn = os.path.join(self.output_directory, os.path.relpath(fn, root))
+                out_dir = os.path.dirname(out_fn)
+                if not self.is_directory(out_dir):
+                    os.makedirs(out_dir, exist_ok=True)
+                    self.directories[out_dir] = True
+            else:
+                out_fn = os.path.join(self.output_directory, os.path.basename(fn))
             out_fn = out_fn[:-len(extension)] + '.pyi'
         else:
             out_fn = fn[:-len(extension)] + '.pyi'
         self.output_fn = os.path.normpath(out_fn)
         #
+        # Use the cached stubs if neither s nor the configuration has changed.
+        cache = self.get_cache()
+        if cache:
+            key = cache.make_key(s)
+            stubs = cache.get(key)
+            if stubs is not None:
+                return self.write_cached_stubs(stubs)
+        #
         # Process s.
         node = ast.parse(s, filename=fn, mode='exec')
-        StubTraverser(controller=self).run(node)
+        st = StubTraverser(controller=self)
+        stubs = st.run(node)
+        if cache and stubs is not None:
+            cache.put(key, stubs)
+        return st.written
+    #@+node:ekr.20261017101011.2: *4* msf.is_directory
+    def is_directory(self, path: str) -> bool:
+        """
+        Return True if path is a directory.
+
+        Stat each directory at most once per batch of stub files:
+        make_stub_files and watch clear self.directories.
+        """
+        result = self.directories.get(path)
+        if result is None:
+            result = self.directories[path] = os.path.isdir(path)
+        return result
+    #@+node:ekr.20261017091001.1: *4* msf.get_cache
+    # The version of the cached stubs. Increase it whenever a change to this
+    # script changes the stubs that it generates.
+    stub_cache_version = 3
+
+    def get_cache(self) -> Optional["StubCache"]:
+        """
+        Return the StubCache for self.cache_directory, or None.
+
+        --update merges the new stubs with the existing stub file, so the
+        cache can't be used with --update.
+        """
+        if not self.cache_directory or self.update_flag:
+            return None
+        if not self.cache:
+            # The stubs depend on the configuration and these options.
+            salt = '\0'.join([
+                str(self.stub_cache_version),
+                self.config_s,
+                '\n'.join(self.prefix_lines),
+                repr(self.verbose),
+            ])
+            self.cache = StubCache(self.cache_directory, salt)
+        return self.cache
+    #@+node:ekr.20261017091002.1: *4* msf.write_cached_stubs
+    def write_cached_stubs(self, stubs: str) -> Optional[bool]:  # pragma: no cover
+        """
+        Write the cached stubs to self.output_fn, as StubTraverser.run would.
+        Return the result of st.write_stub_file, or None.
+        """
+        fn = self.output_fn
+        st = StubTraverser(controller=self)
+        if not st.check_output_fn(fn):
+            return None
+        return st.write_stub_file(fn, stubs)
+    #@+node:ekr.20261017098004.1: *3* msf.make_stub_string
+    def make_stub_string(self, source: Union[bytes, str], name: str='<string>') -> str:
+        """
+        Return the stubs for source, a string or bytes containing Python
+        code, without a time stamp. name is the file name used in error
+        messages.
+
+        Use the patterns in this Controller. Don't read or write any files.
+        """
+        global g_input_file_name
+        g_input_file_name = name
+        node = ast.parse(source, filename=name, mode='exec')
+        return StubTraverser(controller=self).make_stubs(node)
+    #@+node:ekr.20261017090106.1: *3* msf.make_stub_files & helper
+    def make_stub_files(self) -> None:  # pragma: no cover
+        """
+        Make stub files for all files in self.files.
+
+        If self.jobs > 0, share the work among self.jobs worker processes.
+        Output appears in the order of self.files, followed by a summary of
+        the per-file timings.
+        """
+        if self.profiler:
+            self.profiler.install()
+        self.directories = {}  # Directories may have changed since the last batch.
+        results: List[Optional[bool]] = []  # The results of make_stub_file.
+        if self.jobs:
+            errors, timings = 0, []
+            t1 = time.perf_counter()
+            for fn, output, elapsed, error, result in map_files(
+                make_stub_file_in_worker, self.files, self.jobs,
+                initializer=init_worker, initargs=(self,),
+            ):
+                if output:
+                    print(output, end='')
+                written, stats = result or (None, None)
+                if error:
+                    errors += 1
+                    print(f"error: {fn}\n{error}", end='')
+                if stats:
+                    self.profiler.add_file_stats(fn, stats)
+                results.append(written)
+                timings.append((elapsed, fn))
+            if not self.silent:
+                self.print_timings(timings, errors, time.perf_counter() - t1)
+        else:
+            for fn in self.files:
+                with self.profile_file(fn):
+                    results.append(self.make_stub_file(fn))
+        if not self.silent:
+            written, unchanged = results.count(True), results.count(False)
+            print(
+                f"{written} stub file{'' if written == 1 else 's'} written, "
+                f"{unchanged} unchanged")
+        if self.profiler:
+            self.report_profile()
+    #@+node:ekr.20261017090107.1: *4* msf.print_timings
+    def print_timings(self, timings: List[Tuple[float, str]], errors: int, elapsed: float) -> None:  # pragma: no cover
+        """Print a summary of the per-file timings."""
+        n = len(timings)
+        total = sum(z[0] for z in timings)
+        print('')
+        print(
+            f"{n} file{'' if n == 1 else 's'}, {errors} error{'' if errors == 1 else 's'}, "
+            f"{self.jobs} job{'' if self.jobs == 1 else 's'}: "
+            f"{elapsed:.2f} sec. elapsed, {total:.2f} sec. total")
+        slowest = sorted(timings, reverse=True)[:10]
+        if slowest:
+            print('slowest files...')
+            for t, fn in slowest:
+                print(f"  {t:7.3f} sec. {fn}")
+    #@+node:ekr.20261017094002.1: *3* msf.watch & helper
+    watch_interval = 0.5  # Seconds between polls of the input files.
+
+    def watch(self) -> None:  # pragma: no cover
+        """
+        Regenerate the stub files for the files in self.file_patterns
+        whenever the files change, until the user types Ctrl-C.
+
+        The patterns remain in memory: changes to the configuration file
+        have no effect. The globs are expanded again on each poll, so new
+        files are noticed.
+        """
+        if not self.update_flag:
+            # Changed files must replace their existing stubs.
+            self.overwrite = True
+        if self.profiler:
+            self.profiler.install()
+        mtimes = self.get_mtimes()
+        if not self.silent:
+            print(f"watching {len(mtimes)} file{'' if len(mtimes) == 1 else 's'}. Ctrl-C to exit")
+        try:
+            while True:
+                time.sleep(self.watch_interval)
+                new_mtimes = self.get_mtimes()
+                changed = changed_files(mtimes, new_mtimes)
+                mtimes = new_mtimes
+                self.directories = {}  # Directories may have changed while sleeping.
+                for fn in changed:
+                    t1 = time.perf_counter()
+                    try:
+                        with self.profile_file(fn):
+                            self.make_stub_file(fn)
+                    except Exception:
+                        # Keep watching after syntax errors, etc.
+                        import traceback
+                        traceback.print_exc()
+                    if not self.silent:
+                        print(f"{time.perf_counter() - t1:7.3f} sec. {fn}")
+        except KeyboardInterrupt:
+            if self.profiler:
+                self.report_profile()
+    #@+node:ekr.20261017094003.1: *4* msf.get_mtimes
+    def get_mtimes(self) -> Dict[str, float]:
+        """Return a dict mapping the existing files in self.file_patterns to their modification times."""
+        d: Dict[str, float] = {}
+        for pattern in self.file_patterns:
+            for fn in self.find_files(pattern):
+                try:
+                    d[fn] = os.stat(fn).st_mtime
+                except OSError:
+                    pass  # The file has just been deleted.
+        return d
+    #@+node:ekr.20261017096002.1: *3* msf.profile_file & report_profile
+    def profile_file(self, fn: str) -> ContextManager:
+        """
+        Return a context manager that profiles the making of the stub file
+        for fn, if --profile is in effect.
+        """
+        if self.profiler:
+            return self.profiler.profile_file(fn)
+        # A no-op context manager. contextlib.nullcontext requires Python 3.7.
+        return contextlib.suppress()
+
+    def report_profile(self) -> None:  # pragma: no cover
+        """Print the profile, or write it to self.profile_fn."""
+        if self.profile_fn:
+            import json
+            with open(self.profile_fn, 'w') as f:
+                json.dump(self.profiler.to_json(), f, indent=2, sort_keys=True)
+            if not self.silent:
+                print('wrote: %s' % self.profile_fn)
+        else:
+            self.profiler.report()
     #@+node:ekr.20160318141204.131: *3* msf.scan_command_line
     def scan_command_line(self) -> None:  # pragma: no cover
         """Set ivars from command-line arguments."""
+        import argparse
         # The parser implements the --help option.
         description = 'Create stub (.pyi) files using patterns, not type inference.'
         usage = 'make_stub_files.py [options] file1, file2, ...'
         parser = argparse.ArgumentParser(description=description, usage=usage)
         add = parser.add_argument
-        add('files', metavar='FILE', type=str, nargs='+',
+        add('files', metavar='FILE', type=str, nargs='*',
             help='input files')
+        add('--benchmark', action='store_true', default=False,
+            help='time the phases of the stub pipeline; print JSON')
         add('-c', '--config', dest='fn', metavar='FILE',
             help='full path to configuration file')
+        add('--cache', dest='cache', metavar='DIR',
+            help='full path to the directory of the stub cache')
         add('-d', '--dir', dest='dir',
             help='full path to the output directory')
+        add('--exclude', dest='excludes', metavar='PATTERN', action='append', default=[],
+            help='--recursive: skip files and directories matching PATTERN')
         add('-f', '--force-pyx', action='store_true', default=False,
             help='force the parsing of .pyx files')
+        add('-j', '--jobs', dest='jobs', metavar='N', type=int, default=0,
+            help='make stubs using N worker processes')
+        add('--memoize', action='store_true', default=False,
+            help='format repeated expressions once per file')
+        add('--no-time-stamp', dest='time_stamp', action='store_false', default=True,
+            help='omit the time stamp from stub files')
         add('-o', '--overwrite', action='store_true', default=False,
             help='overwrite existing stub (.pyi) files')
+        add('--profile', action='store_true', default=False,
+            help='print the time spent in hot functions')
+        add('--profile-json', dest='profile_json', metavar='FILE',
+            help='write the --profile data to FILE as JSON')
+        add('-r', '--recursive', action='store_true', default=False,
+            help='make stubs for all files in the trees of directories')
         add('-s', '--silent', action='store_true', default=False,
             help='run without messages')
+        add('--server', action='store_true', default=False,
+            help='make stubs on request: JSON lines on stdin/stdout')
+        add('--socket', dest='socket', metavar='PATH',
+            help='--server: use the Unix domain socket PATH')
         add('--trace-matches', action='store_true', default=False,
             help='trace Pattern.matches')
         add('--trace-patterns', action='store_true', default=False,
@@ -1064,11 +1780,15 @@ class Controller:
             help='verbose output in .pyi file')
         add('-w', '--warn', action='store_true', default=False,
             help='warn about unannotated args')
+        add('--watch', action='store_true', default=False,
+            help='regenerate stubs whenever the input files change')
         # Parse.
         args = parser.parse_args()
         # Handle the args...
+        self.benchmark_flag = args.benchmark
         self.overwrite = args.overwrite
         self.silent = args.silent
+        self.time_stamp_flag = args.time_stamp
         self.trace_matches = args.trace_matches
         self.trace_patterns = args.trace_patterns
         self.trace_reduce = args.trace_reduce
@@ -1077,8 +1797,26 @@ class Controller:
         self.verbose = args.verbose
         self.warn = args.warn
         self.force_pyx = args.force_pyx
+        self.excludes.extend(args.excludes)
+        self.jobs = max(0, args.jobs)
+        self.memoize = args.memoize
+        self.recursive = args.recursive
+        self.watch_flag = args.watch
+        self.server_flag = args.server or bool(args.socket)
+        self.socket_path = args.socket
+        if args.profile or args.profile_json:
+            self.profiler = Profiler()
+            self.profile_fn = args.profile_json
         if args.fn:
             self.config_fn = args.fn
+        if args.cache:
+            dir_ = finalize(args.cache.strip())
+            if os.path.isdir(dir_):
+                self.cache_directory = dir_
+            else:
+                print('--cache: directory does not exist: %s' % dir_)
+                print('exiting')
+                sys.exit(1)
         if args.dir:
             dir_ = args.dir and args.dir.strip()
             dir_ = finalize(dir_)
@@ -1098,28 +1836,136 @@ class Controller:
             print('')
             print(f"configuration file: {self.config_fn}")
         if not self.config_fn:  # pragma: no cover
+            if self.files:
+                self.scan_files(self.files, 'command-line')
             return
-        self.parser = parser = self.create_parser()
-        s = self.get_config_string()
-        self.init_parser(s)
+        s = self.config_s = self.get_config_string()
+        # Use the cached [Global] options and pattern tables if possible.
+        cached = self.load_config_cache(s)
+        if cached:
+            self.parser = None  # The parser property creates the parser if needed.
+        else:
+            self.parser = parser = self.create_parser()
+            self.init_parser(s)
+            if parser.has_section('Global'):
+                self.global_options = dict(parser.items('Global'))
+        options = self.global_options
+        if 'exclude' in options:
+            excludes = options['exclude']
+            self.excludes.extend(z.strip() for z in excludes.split('\n') if z.strip())
         if self.files:  # pragma: no cover
-            files_source = 'command-line'
-            files = self.files
-            if isinstance(files, str):
-                files = [files]
-        elif parser.has_section('Global'):
-            files_source = 'config file'
-            files = parser.get('Global', 'files')  # type:ignore
-            files = [z.strip() for z in files.split('\n') if z.strip()]  # type:ignore
+            self.scan_files(self.files, 'command-line')
+        elif 'files' in options:
+            files = options['files']
+            self.scan_files([z.strip() for z in files.split('\n') if z.strip()], 'config file')
         else:  # pragma: no cover
             return
+        if 'output_directory' in options:
+            s = options['output_directory'].strip()
+            output_dir = finalize(s)
+            if os.path.exists(output_dir):
+                self.output_directory = output_dir
+                if self.verbose:  # pragma: no cover
+                    print(f"output directory: {output_dir}")
+            else:  # pragma: no cover
+                print(f"output directory not found: {output_dir}")
+                self.output_directory = None  # inhibit run().
+        if self.verbose:  # pragma: no cover
+            print('')
+        if not cached:
+            self.scan_patterns_and_prefix_lines()
+            self.save_config_cache(self.config_s)
+    #@+node:ekr.20261017101012.1: *4* msf.load_config_cache & save_config_cache
+    # The version of the cached tables. Increase it whenever their format changes.
+    config_cache_version = 1
+
+    def config_cache_path(self, s: str) -> Optional[str]:
+        """
+        Return the path to the cache entry for s, the contents of the
+        configuration file, or None if --cache is not in effect.
+        """
+        if not self.cache_directory or self.trace_patterns:
+            return None
+        import hashlib
+        h = hashlib.sha256(s.encode('utf-8', errors='surrogatepass'))
+        return os.path.join(self.cache_directory, 'config', h.hexdigest() + '.marshal')
+
+    def load_config_cache(self, s: str) -> bool:
+        """
+        Set the [Global] options, the prefix lines and all pattern tables
+        from the cache entry for s, the contents of the configuration file.
+
+        Return True if the entry exists and was made from s with the current
+        config_cache_version and stub_cache_version.
+
+        Loading skips configparser and the scanning of the patterns. The
+        Patterns still compile their regexes.
+        """
+        import marshal
+        fn = self.config_cache_path(s)
+        if not fn:
+            return False
+        try:
+            with open(fn, 'rb') as f:
+                data = marshal.load(f)
+            header, tables = data[:3], data[3:]
+        except Exception:  # Missing, unreadable or corrupt.
+            return False
+        if header != (self.config_cache_version, self.stub_cache_version, s):  # pragma: no cover
+            return False
+        (self.global_options, self.prefix_lines, def_patterns, general_patterns,
+            self.names_dict, patterns_dict, regex_patterns) = tables
+        self.def_patterns = [Pattern(*z) for z in def_patterns]
+        self.general_patterns = general = [Pattern(*z) for z in general_patterns]
+        self.patterns_dict = {
+            name: [general[i] for i in indices] for name, indices in patterns_dict.items()}
+        self.regex_patterns = [general[i] for i in regex_patterns]
+        self.compiled_patterns.compile(self.patterns_dict, self.regex_patterns)
+        self.patterns_config_s = s
+        return True
+
+    def save_config_cache(self, s: str) -> None:
+        """
+        Write the tables computed by scan_options to the cache entry for s.
+
+        Patterns appear as (find_s, repl_s) tuples. The values of
+        patterns_dict and regex_patterns are indices into general_patterns.
+        marshal needs no imports and is much faster than pickle.
+        """
+        import marshal
+        fn = self.config_cache_path(s)
+        if not fn:
+            return
+        general = self.general_patterns
+        indices = {id(z): i for i, z in enumerate(general)}
+        data = (
+            self.config_cache_version, self.stub_cache_version, s,
+            self.global_options,
+            self.prefix_lines,
+            [(z.find_s, z.repl_s) for z in self.def_patterns],
+            [(z.find_s, z.repl_s) for z in general],
+            self.names_dict,
+            {name: [indices[id(z)] for z in aList] for name, aList in self.patterns_dict.items()},
+            [indices[id(z)] for z in self.regex_patterns],
+        )
+        try:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            atomic_write(fn, marshal.dumps(data))
+        except (OSError, ValueError) as e:  # pragma: no cover
+            print('can not write config cache entry: %s: %s' % (fn, e))
+    #@+node:ekr.20261017101002.2: *4* msf.scan_files & find_files
+    def scan_files(self, files: Union[str, List[str]], files_source: str) -> None:
+        """Set self.file_patterns and self.files from files, a list of globs."""
+        if isinstance(files, str):
+            files = [files]
         if self.verbose:  # pragma: no cover
             print(f"Files (from {files_source})...")
+        self.file_patterns = [finalize(z) for z in files]
         files2 = []
         not_found = []
         for z in files:
             # Warn if z does not exist.
-            files3 = glob.glob(finalize(z))
+            files3 = self.find_files(finalize(z))
             if files3:
                 if self.verbose:  # pragma: no cover
                     for z in files3:
@@ -1132,32 +1978,41 @@ class Controller:
             for z in not_found:
                 print(f"  {z}")
         self.files = files2
-        if 'output_directory' in parser.options('Global'):
-            s = parser.get('Global', 'output_directory').strip()
-            output_dir = finalize(s)
-            if os.path.exists(output_dir):
-                self.output_directory = output_dir
-                if self.verbose:  # pragma: no cover
-                    print(f"output directory: {output_dir}")
-            else:  # pragma: no cover
-                print(f"output directory not found: {output_dir}")
-                self.output_directory = None  # inhibit run().
-        if 'prefix_lines' in parser.options('Global'):
-            prefix = parser.get('Global', 'prefix_lines')
-            prefix_lines = prefix.split('\n')
-                # The parser does not preserve leading whitespace.
-            self.prefix_lines = [z for z in prefix_lines if z.strip()]
-            # Annoying
-                # if self.verbose:
-                    # print('Prefix lines...\n')
-                    # for z in self.prefix_lines:
-                        # print('  %s' % z)
-                    # print('')
-        if self.verbose:  # pragma: no cover
-            print('')
-        self.def_patterns = self.scan_patterns('Def Name Patterns')
-        self.general_patterns = self.scan_patterns('General Patterns')
-        self.make_patterns_dict()
+
+    def find_files(self, pattern: str) -> List[str]:
+        """
+        Return the files matching the glob pattern.
+
+        --recursive: replace each directory by the source files in its tree,
+        and remember the directory in self.source_roots.
+        """
+        files = glob.glob(pattern)
+        if not self.recursive:
+            return files
+        extensions = ('.py', '.pyx') if self.force_pyx else ('.py',)
+        result = []
+        for fn in files:
+            if os.path.isdir(fn):
+                for fn2 in find_source_files(fn, self.excludes, extensions):
+                    self.source_roots[fn2] = fn
+                    result.append(fn2)
+            else:
+                result.append(fn)
+        return result
+    #@+node:ekr.20261017098002.1: *4* msf.load_config
+    def load_config(self, s: str) -> None:
+        """
+        Set all pattern-related ivars from s, the contents of a configuration
+        file. Unlike scan_options, don't read or search for any files.
+        """
+        self.parser = self.create_parser()
+        self.config_s = s
+        self.init_parser(s)
+        self.names_dict = {}
+        self.patterns_dict = {}
+        self.prefix_lines = []
+        self.regex_patterns = []
+        self.scan_patterns_and_prefix_lines()
     #@+node:ekr.20160318141204.133: *4* msf.make_op_name_dict
     def make_op_name_dict(self) -> Dict[str, List[str]]:
         """
@@ -1186,9 +2041,28 @@ class Controller:
     #@+node:ekr.20160318141204.134: *4* msf.create_parser
     def create_parser(self) -> Any:
         """Create a RawConfigParser and return it."""
+        from collections import OrderedDict
+        import configparser
         parser = configparser.RawConfigParser(dict_type=OrderedDict)
         parser.optionxform = str # type:ignore
         return parser
+    #@+node:ekr.20261017101013.6: *4* msf.parser
+    @property
+    def parser(self) -> Any:
+        """
+        The RawConfigParser for self.config_s.
+
+        A config-cache hit skips configparser entirely, so create the parser
+        only when something needs it.
+        """
+        if self.config_parser is None:
+            self.config_parser = self.create_parser()
+            self.init_parser(self.config_s)
+        return self.config_parser
+
+    @parser.setter
+    def parser(self, parser: Any) -> None:
+        self.config_parser = parser
     #@+node:ekr.20160318141204.135: *4* msf.find_pattern_ops
     def find_pattern_ops(self, pattern: "Pattern") -> List[str]:
         """Return a list of operators in pattern.find_s."""
@@ -1305,6 +2179,26 @@ class Controller:
                 for pattern in sorted(aList):
                     print('  ' + repr(pattern))
         # Note: retain self.general_patterns for use in argument lists.
+        self.compiled_patterns.compile(self.patterns_dict, self.regex_patterns)
+    #@+node:ekr.20261017098003.1: *4* msf.scan_patterns_and_prefix_lines
+    def scan_patterns_and_prefix_lines(self) -> None:
+        """Set the prefix lines and all patterns from self.parser."""
+        parser = self.parser  # type:ignore
+        if parser.has_section('Global') and 'prefix_lines' in parser.options('Global'):
+            prefix = parser.get('Global', 'prefix_lines')
+            prefix_lines = prefix.split('\n')
+                # The parser does not preserve leading whitespace.
+            self.prefix_lines = [z for z in prefix_lines if z.strip()]
+            # Annoying
+                # if self.verbose:
+                    # print('Prefix lines...\n')
+                    # for z in self.prefix_lines:
+                        # print('  %s' % z)
+                    # print('')
+        self.def_patterns = self.scan_patterns('Def Name Patterns')
+        self.general_patterns = self.scan_patterns('General Patterns')
+        self.make_patterns_dict()
+        self.patterns_config_s = self.config_s
     #@+node:ekr.20160318141204.140: *4* msf.scan_patterns
     def scan_patterns(self, section_name: str) -> List["Pattern"]:
         """Parse the config section into a list of patterns, preserving order."""
@@ -1477,6 +2371,7 @@ class LeoGlobals:  # pragma: no cover
         return '%s...\n%s\n' % (tag, s) if tag else s
     #@+node:ekr.20160318141204.98: *3* g.pdb
     def pdb(self) -> None:
+        import pdb
         pdb.set_trace()
     #@+node:ekr.20180902034446.1: *3* g.printObj
     def printObj(self, obj: Any, indent: str='', printCaller: bool=False, tag: str=None) -> None:
@@ -1523,9 +2418,11 @@ class Pattern:
         self.find_s: str = find_s
         self.repl_s: str = repl_s
         self.regex: Any
+        # Cache the kind of the pattern: match and friends are called often.
+        self.balanced = self.is_balanced()
         if self.is_regex():
             self.regex = re.compile(find_s)
-        elif self.is_balanced():
+        elif self.balanced:
             self.regex = None
         else:
             # Escape all dangerous characters.
@@ -1580,7 +2477,7 @@ class Pattern:
         Return a list of match objects for all matches in s.
         These are regex match objects or (start, end) for balanced searches.
         """
-        if self.is_balanced():
+        if self.balanced:
             aList, i = [], 0
             while i < len(s):
                 progress = i
@@ -1647,7 +2544,7 @@ class Pattern:
         Perform the match on the entire string if possible.
         Return (found, new s)
         """
-        if self.is_balanced():
+        if self.balanced:
             j = self.full_balanced_match(s, 0)
             if j is None:
                 return False, s
@@ -1662,7 +2559,7 @@ class Pattern:
     #@+node:ekr.20160318141204.112: *3* pattern.match_entire_string
     def match_entire_string(self, s: str) -> bool:
         """Return True if s matches self.find_s"""
-        if self.is_balanced():
+        if self.balanced:
             j = self.full_balanced_match(s, 0)
             return j == len(s)
         m = self.regex.match(s)
@@ -1670,7 +2567,7 @@ class Pattern:
     #@+node:ekr.20160318141204.113: *3* pattern.replace & helpers
     def replace(self, m: Any, s: str) -> str:
         """Perform any kind of replacement."""
-        if self.is_balanced():
+        if self.balanced:
             start, end = m
             return self.replace_balanced(s, start, end)
         return self.replace_regex(m, s)
@@ -1708,6 +2605,155 @@ class Pattern:
                 s = s.replace(group, m.group(i))
         return s
     #@-others
+#@+node:ekr.20261017096001.1: ** class Profiler
+class Profiler:
+    """
+    Record the wall time and the number of calls of the functions in the
+    hot paths of make_stub_files, per file and in aggregate.
+
+    install() replaces the functions by wrappers. Nothing is wrapped unless
+    --profile is in effect, so profiling costs nothing when it is off.
+
+    Times are inclusive: the time of match_all includes the time of the
+    Pattern.match calls it makes. The time of recursive calls counts once.
+    """
+    #@+others
+    #@+node:ekr.20261017096001.2: *3* profiler.ctor
+    def __init__(self) -> None:
+        """Ctor for the Profiler class."""
+        # Keys are target names. Values are [calls, seconds].
+        self.current: Dict[str, List[float]] = self.new_stats()
+        # Keys are file names. Values are stats dicts, like self.current.
+        self.files: Dict[str, Dict[str, List[float]]] = {}
+    #@+node:ekr.20261017096001.3: *3* profiler.add_file_stats & new_stats
+    def add_file_stats(self, fn: str, stats: Dict[str, List[float]]) -> None:
+        """Add the stats of fn, computed in another process, to self.files."""
+        self.files[fn] = stats
+
+    # The key of the --memoize stats. Values are [hits, lookups].
+    memo_key = 'StubFormatter.memo'
+
+    def add_memo_stats(self, hits: int, lookups: int) -> None:
+        """Add the hits and lookups of --memoize to self.current."""
+        entry = self.current.setdefault(self.memo_key, [0, 0])
+        entry[0] += hits
+        entry[1] += lookups
+
+    def new_stats(self) -> Dict[str, List[float]]:
+        """Return a new stats dict."""
+        return {name: [0, 0.0] for name in self.target_names}
+    #@+node:ekr.20261017096001.4: *3* profiler.aggregate
+    def aggregate(self) -> Dict[str, List[float]]:
+        """Return the sum of the stats of all files."""
+        total = self.new_stats()
+        for stats in self.files.values():
+            for name, (calls, t) in stats.items():
+                entry = total.setdefault(name, [0, 0])
+                entry[0] += calls
+                entry[1] += t
+        return total
+    #@+node:ekr.20261017096001.5: *3* profiler.install & uninstall
+    # The functions to profile: (name of class or None for this module, name of function).
+    targets = (
+        ('Pattern', 'match'),
+        ('StubFormatter', 'match_all'),
+        ('ReduceTypes', 'reduce_types'),
+        (None, 'is_known_type'),
+        ('StubTraverser', 'format_returns'),
+        ('StubTraverser', 'merge_stubs'),
+    )
+    target_names = tuple(
+        f"{class_name}.{name}" if class_name else name for class_name, name in targets)
+
+    def get_owner(self, class_name: Optional[str]) -> Any:
+        """Return the class or module containing a target."""
+        module = sys.modules[__name__]
+        return getattr(module, class_name) if class_name else module
+
+    def install(self) -> None:
+        """Replace all targets by wrappers that update self.current."""
+        for (class_name, name), full_name in zip(self.targets, self.target_names):
+            owner = self.get_owner(class_name)
+            function = self.unwrap(getattr(owner, name))
+            setattr(owner, name, self.wrap(full_name, function))
+
+    def uninstall(self) -> None:
+        """Restore all targets."""
+        for class_name, name in self.targets:
+            owner = self.get_owner(class_name)
+            setattr(owner, name, self.unwrap(getattr(owner, name)))
+    #@+node:ekr.20261017096001.6: *3* profiler.profile_file
+    @contextlib.contextmanager
+    def profile_file(self, fn: str) -> Iterator[None]:
+        """A context manager that profiles the making of the stub file for fn."""
+        self.current = self.new_stats()
+        try:
+            yield
+        finally:
+            self.files[fn] = self.current
+    #@+node:ekr.20261017096001.7: *3* profiler.report & to_json
+    def report(self) -> None:  # pragma: no cover
+        """Print the aggregate stats, sorted by time."""
+        total = self.aggregate()
+        memo = total.pop(self.memo_key, None)
+        n = len(self.files)
+        print('')
+        print(f"profile: {n} file{'' if n == 1 else 's'}")
+        print(f"{'calls':>10} {'sec.':>9} {'usec/call':>10}  function")
+        for name, (calls, t) in sorted(total.items(), key=lambda z: (-z[1][1], z[0])):
+            per_call = 1e6 * t / calls if calls else 0.0
+            print(f"{int(calls):10} {t:9.3f} {per_call:10.2f}  {name}")
+        if memo:
+            hits, lookups = memo
+            rate = 100.0 * hits / lookups if lookups else 0.0
+            print(f"memo: {int(hits)} hits in {int(lookups)} lookups ({rate:.0f}%)")
+
+    def to_json(self) -> Dict[str, Any]:
+        """Return the aggregate and per-file stats as a dict suitable for json.dump."""
+
+        def convert(stats: Dict[str, List[float]]) -> Dict[str, Dict[str, float]]:
+            return {
+                name: (
+                    {'hits': int(calls), 'lookups': int(t)} if name == self.memo_key
+                    else {'calls': int(calls), 'seconds': t})
+                for name, (calls, t) in stats.items()
+            }
+
+        return {
+            'aggregate': convert(self.aggregate()),
+            'files': {fn: convert(stats) for fn, stats in self.files.items()},
+        }
+    #@+node:ekr.20261017096001.8: *3* profiler.wrap & unwrap
+    def unwrap(self, function: Callable) -> Callable:
+        """Return the function wrapped by any Profiler."""
+        while getattr(function, 'profiler_wrapper', False):
+            function = function.__wrapped__  # type:ignore
+        return function
+
+    def wrap(self, name: str, function: Callable) -> Callable:
+        """Return a wrapper for function that updates self.current[name]."""
+        perf_counter = time.perf_counter
+        depth = 0
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            nonlocal depth
+            entry = self.current[name]
+            entry[0] += 1
+            if depth:
+                # Count only the time of the outermost call.
+                return function(*args, **kwargs)
+            depth += 1
+            t1 = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                entry[1] += perf_counter() - t1
+                depth -= 1
+
+        wrapper.profiler_wrapper = True  # type:ignore
+        return wrapper
+    #@-others
 #@+node:ekr.20160318141204.116: ** class ReduceTypes
 class ReduceTypes:
     """
@@ -1726,63 +2772,8 @@ class ReduceTypes:
         self.trace = trace
     #@+node:ekr.20160318141204.118: *3* rt.is_known_type
     def is_known_type(self, s: str) -> bool:
-        """
-        Return True if s is nothing but a single known type.
-
-        It suits the other methods of this class *not* to test inside inner
-        brackets. This prevents unwanted Any types.
-        """
-        s = s.strip()
-        types_table = (
-            '', 'None',  # Tricky.
-            'complex', 'float', 'int', 'long', 'number',
-            'dict', 'list', 'tuple',
-            'bool', 'bytes', 'str', 'unicode',
-        )
-        for s2 in types_table:
-            if s2 == s:
-                return True
-            if s2 and Pattern(s2 + '(*)', s).match_entire_string(s):  # 2021/08/08
-                return True
-        if s.startswith('[') and s.endswith(']'):
-            inner = s[1:-1]
-            return self.is_known_type(inner) if inner else True
-        if s.startswith('(') and s.endswith(')'):
-            inner = s[1:-1]
-            return self.is_known_type(inner) if inner else True
-        if s.startswith('{') and s.endswith('}'):
-            return True
-        names_table = (
-            # Pep 484: https://www.python.org/dev/peps/pep-0484/
-            # typing module: https://docs.python.org/3/library/typing.html
-            # Test the most common types first.
-            'Any', 'Dict', 'List', 'Optional', 'Tuple', 'Union',
-            # Not generated by this program, but could arise from patterns.
-            'AbstractSet', 'AnyMeta', 'AnyStr',
-            'BinaryIO', 'ByteString',
-            'Callable', 'CallableMeta', 'Container',
-            'Final', 'Generic', 'GenericMeta', 'Hashable',
-            'IO', 'ItemsView', 'Iterable', 'Iterator',
-            'KT', 'KeysView',
-            'Mapping', 'MappingView', 'Match',
-            'MutableMapping', 'MutableSequence', 'MutableSet',
-            'NamedTuple', 'OptionalMeta',
-            # 'POSIX', 'PY2', 'PY3',
-            'Pattern', 'Reversible',
-            'Sequence', 'Set', 'Sized',
-            'SupportsAbs', 'SupportsFloat', 'SupportsInt', 'SupportsRound',
-            'T', 'TextIO', 'TupleMeta', 'TypeVar', 'TypingMeta',
-            'Undefined', 'UnionMeta',
-            'VT', 'ValuesView', 'VarBinding',
-        )
-        for s2 in names_table:
-            if s2 == s:
-                return True
-            # Don't look inside bracketss.
-            pattern = Pattern(s2 + '[*]', s)
-            if pattern.match_entire_string(s):
-                return True
-        return False
+        """Return True if s is nothing but a single known type."""
+        return is_known_type(s)
     #@+node:ekr.20160318141204.119: *3* rt.reduce_collection
     def reduce_collection(self, aList: List[str], kind: str) -> List[str]:
         """
@@ -1906,18 +2897,25 @@ class Stub:
     """
     A class representing all the generated stub for a class or def.
     stub.full_name should represent the complete context of a def.
+
+    Large programs create many stubs, so stubs have no __dict__.
     """
+    __slots__ = ('children', 'full_name', 'hash', 'kind', 'name', 'out_list', 'parent')
     #@+others
     #@+node:ekr.20160318141204.142: *3* stub.ctor
     def __init__(self, kind: str, name: str, parent: "Stub"=None, stack: List[str]=None) -> None:
-        """Stub ctor. Equality depends only on full_name and kind."""
+        """
+        Stub ctor. Equality depends only on full_name and kind.
+
+        stack is StubTraverser.context_stack. full_name contains a copy of it.
+        """
         self.children: List[Stub] = []
-        self.full_name = '%s.%s' % ('.'.join(stack), name) if stack else name
+        self.full_name = sys.intern('%s.%s' % ('.'.join(stack), name) if stack else name)
+        self.hash = hash((self.full_name, kind))
         self.kind = kind
         self.name = name
         self.out_list: List[str] = []
         self.parent = parent
-        self.stack = stack  # StubTraverser.context_stack.
         if stack:
             assert stack[-1] == parent.name, (stack[-1], parent.name)
         if parent:
@@ -1939,7 +2937,7 @@ class Stub:
     #@+node:ekr.20160318141204.144: *3* stub.__hash__
     def __hash__(self) -> int:
         """Stub.__hash__. Equality depends *only* on full_name and kind."""
-        return len(self.kind) + sum([ord(z) for z in self.full_name])
+        return self.hash
     #@+node:ekr.20160318141204.145: *3* stub.__repr__and __str__
     def __repr__(self) -> str:
         """Stub.__repr__."""
@@ -1956,6 +2954,59 @@ class Stub:
         """Return a list of this stub's parents."""
         return self.full_name.split('.')[:-1]
     #@-others
+#@+node:ekr.20261017091006.1: ** class StubCache
+class StubCache:
+    """
+    A persistent, content-addressed cache of generated stubs.
+
+    The key of each entry is a hash of the source file, the configuration
+    and Controller.stub_cache_version. Each entry is a file in the cache
+    directory containing the stubs, without the time stamp.
+
+    Writes are atomic, so worker processes may share the cache.
+    """
+    #@+others
+    #@+node:ekr.20261017091007.1: *3* cache.ctor
+    def __init__(self, directory: str, salt: str) -> None:
+        """
+        Ctor for the StubCache class.
+
+        salt represents everything, besides the source, that affects the stubs.
+        """
+        import hashlib
+        self.directory = directory
+        self.salt = hashlib.sha256(salt.encode('utf-8')).hexdigest()
+    #@+node:ekr.20261017091008.1: *3* cache.get & put
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached stubs for key, or None."""
+        try:
+            with open(self.path(key), 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key: str, stubs: str) -> None:
+        """Add the stubs for key to the cache."""
+        fn = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            atomic_write(fn, stubs, encoding='utf-8')
+        except OSError as e:  # pragma: no cover
+            print('can not write cache entry: %s: %s' % (fn, e))
+    #@+node:ekr.20261017091009.1: *3* cache.make_key & path
+    def make_key(self, source: Union[bytes, str]) -> str:
+        """Return the key for the given source."""
+        import hashlib
+        h = hashlib.sha256(self.salt.encode('ascii'))
+        if isinstance(source, str):
+            source = source.encode('utf-8', errors='surrogatepass')
+        h.update(source)
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        """Return the full path to the cache entry for key."""
+        return os.path.join(self.directory, key[:2], key[2:] + '.pyi')
+    #@-others
 #@+node:ekr.20160318141204.147: ** class StubFormatter (AstFormatter)
 class StubFormatter(AstFormatter):
     """
@@ -1969,6 +3020,7 @@ class StubFormatter(AstFormatter):
         self.controller = x = controller
         self.traverser = traverser
             # 2016/02/07: to give the formatter access to the class_stack.
+        self.compiled_patterns = x.compiled_patterns
         self.def_patterns: List["Pattern"] = x.def_patterns
         self.general_patterns = x.general_patterns
         self.names_dict: Dict[str, str] = x.names_dict
@@ -1980,30 +3032,98 @@ class StubFormatter(AstFormatter):
         self.trace_reduce = x.trace_reduce
         self.trace_visitors = x.trace_visitors
         self.verbose = x.verbose
+        # --memoize...
+        self.fingerprints: Dict[int, int] = {}  # Keys are id(node). Cleared by format.
+        self.structures: Dict[Tuple, int] = {}  # Values are fingerprints.
+        self.memo: Optional[Dict[int, str]] = None  # Keys are fingerprints.
+        self.memo_hits = self.memo_misses = 0
+        if x.memoize:
+            self.memo = {}
+            self.visit = self.visit_memo  # type:ignore
         # mypy workarounds
         self.seen_names: List[str] = []
+    #@+node:ekr.20261017101006.1: *3* sf.format & --memoize
+    def format(self, node: Node) -> str:
+        """StubFormatter.format."""
+        self.fingerprints = {}
+        return AstFormatter.format(self, node)
+
+    def fingerprint(self, node: Node) -> int:
+        """
+        Return the fingerprint of an ast node: an int that is the same for
+        all structurally equal nodes in the file.
+
+        Compute the fingerprints of node's descendants bottom-up, using an
+        explicit stack, so deeply nested expressions don't recurse.
+        """
+        fingerprints = self.fingerprints
+        key = fingerprints.get(id(node))
+        if key is not None:
+            return key
+        structures = self.structures
+        stack: List[Tuple[Node, bool]] = [(node, False)]
+        while stack:
+            z, children_done = stack.pop()
+            if id(z) in fingerprints:
+                continue
+            if not children_done:
+                stack.append((z, True))
+                stack.extend((z2, False) for z2 in ast.iter_child_nodes(z))
+                continue
+            structure: List[Any] = [z.__class__]
+            for field in z._fields:
+                value = getattr(z, field, None)
+                if isinstance(value, ast.AST):
+                    structure.append(fingerprints[id(value)])
+                elif isinstance(value, list):
+                    structure.append(tuple([
+                        fingerprints[id(z2)] if isinstance(z2, ast.AST) else (z2.__class__, z2)
+                        for z2 in value]))
+                else:
+                    # Include the class: 1 == 1.0 == True.
+                    structure.append((value.__class__, value))
+            fingerprints[id(z)] = structures.setdefault(tuple(structure), len(structures))
+        return fingerprints[id(node)]
+
+    # The classes whose visitors call match_all.
+    # Other expressions are faster to format than to look up.
+    memoized_classes = frozenset((
+        ast.BinOp, ast.BoolOp, ast.Call, ast.IfExp, ast.Subscript, ast.UnaryOp))
+
+    def visit_memo(self, node: Node) -> str:
+        """
+        StubFormatter.visit for --memoize: format each structurally distinct
+        expression once per file.
+
+        The formatting of an expression depends only on its structure and
+        the patterns, which don't change while making the stubs for a file.
+        """
+        if self.level or node.__class__ not in self.memoized_classes:
+            return AstFormatter.visit(self, node)
+        key = self.fingerprint(node)
+        s = self.memo.get(key)
+        if s is None:
+            self.memo_misses += 1
+            s = self.memo[key] = AstFormatter.visit(self, node)
+        else:
+            self.memo_hits += 1
+        return s
     #@+node:ekr.20160318141204.149: *3* sf.match_all
     matched_d: Dict[str, List[str]] = {}
 
     def match_all(self, node: Node, s: str, trace: bool=False) -> str:
         """Match all the patterns for the given node."""
-        trace = trace or self.trace_matches
-        d = self.matched_d
         name = node.__class__.__name__
-        s1 = truncate(s, 40)
-        patterns = self.patterns_dict.get(name, []) + self.regex_patterns
-        for pattern in patterns:
-            found, s = pattern.match(s, trace=False)
-            if found and trace:  # pragma: no cover
-                caller = g.callers(2).split(',')[1].strip()  # The direct caller of match_all.
-                aList = d.get(name, [])
-                if pattern not in aList:
-                    aList.append(pattern)  # type:ignore
-                    d[name] = aList
-                    print('match_all:    %-12s %26s %40s ==> %s' % (caller, pattern, s1, s))
-            if found:
-                break
-        return s
+        pattern, s2 = self.compiled_patterns.match(name, s)
+        if pattern and (trace or self.trace_matches):  # pragma: no cover
+            d = self.matched_d
+            caller = g.callers(2).split(',')[1].strip()  # The direct caller of match_all.
+            aList = d.get(name, [])
+            if pattern not in aList:
+                aList.append(pattern)  # type:ignore
+                d[name] = aList
+                print('match_all:    %-12s %26s %40s ==> %s' % (caller, pattern, truncate(s, 40), s2))
+        return s2
     #@+node:ekr.20160318141204.151: *3* sf.trace_visitor
     def trace_visitor(self, node: Node, op: str, s: str) -> None:  # pragma: no cover
         """Trace node's visitor."""
@@ -2108,10 +3228,9 @@ class StubFormatter(AstFormatter):
             s = 'str'
         else:
             # Fall back to the base-class behavior.
-            s = '%s%s%s' % (
-                self.visit(node.left),
-                op,
-                self.visit(node.right))
+            # Don't visit node.left and node.right again!
+            # That would take exponential time for chains like a+b+c...
+            s = '%s%s%s' % (lhs, op, rhs)
         s = self.match_all(node, s)
         self.trace_visitor(node, op, s)
         return s
@@ -2210,6 +3329,152 @@ class StubFormatter(AstFormatter):
         assert s.startswith('return'), repr(s)
         return s[len('return'):].strip()
     #@-others
+#@+node:ekr.20261017099001.1: ** class StubServer
+class StubServer:
+    """
+    A long-running server that makes stubs on request, using the patterns
+    of one Controller.
+
+    Requests and responses are JSON objects, one per line. Requests:
+
+        {"id": 1, "source": "def f(): pass", "name": "f.py"}
+        {"id": 2, "path": "/full/path/to/file.py"}
+        {"id": 3, "command": "ping"}
+        {"id": 4, "command": "shutdown"}
+
+    Responses contain the request's id, if any, and either "stubs" or
+    "error". Messages that making the stubs would have printed are in
+    "messages".
+
+    The server reloads the configuration file when it changes.
+    """
+    #@+others
+    #@+node:ekr.20261017099001.2: *3* server.ctor
+    def __init__(self, controller: Controller) -> None:
+        """Ctor for the StubServer class."""
+        self.controller = x = controller
+        self.config_mtime: Optional[float] = None
+        self.running = True
+        if x.config_s and x.patterns_config_s == x.config_s:
+            # scan_options has loaded the patterns. Don't load them again.
+            self.config_mtime = self.get_config_mtime()
+        self.check_config()
+    #@+node:ekr.20261017099001.3: *3* server.check_config & get_config_mtime
+    def check_config(self) -> None:
+        """Load the configuration file if it has changed since the last call."""
+        x = self.controller
+        mtime = self.get_config_mtime()
+        if mtime is None:
+            return  # Keep the patterns.
+        if mtime != self.config_mtime:
+            self.config_mtime = mtime
+            x.load_config(x.get_config_string())
+
+    def get_config_mtime(self) -> Optional[float]:
+        """Return the modification time of the configuration file, or None."""
+        x = self.controller
+        if not x.config_fn:
+            return None
+        try:
+            return os.stat(finalize(x.config_fn)).st_mtime
+        except OSError:
+            return None
+    #@+node:ekr.20261017099001.4: *3* server.handle_line & handle_request
+    def handle_line(self, line: str) -> str:
+        """Return the response to line, one JSON request, as one line of JSON."""
+        import json
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+        except ValueError as e:
+            response = {'error': 'bad request: %s' % e}
+        else:
+            response = self.handle_request(request)
+        return json.dumps(response) + '\n'
+
+    def handle_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the response to request."""
+        response: Dict[str, Any] = {}
+        if 'id' in request:
+            response['id'] = request['id']
+        command = request.get('command', 'stubs')
+        if command == 'ping':
+            response['result'] = 'pong'
+        elif command == 'shutdown':
+            self.running = False
+            response['result'] = 'shutdown'
+        elif command == 'stubs':
+            f = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(f):
+                    response['stubs'] = self.make_stubs(request)
+            except Exception as e:
+                response['error'] = '%s: %s' % (e.__class__.__name__, e)
+            if f.getvalue():
+                response['messages'] = f.getvalue()
+        else:
+            response['error'] = 'unknown command: %s' % command
+        return response
+    #@+node:ekr.20261017099001.5: *3* server.make_stubs
+    def make_stubs(self, request: Dict[str, Any]) -> str:
+        """Return the stubs for the "source" or "path" of request."""
+        self.check_config()
+        path = request.get('path')
+        if 'source' in request:
+            source = request['source']
+        elif path:
+            source = read_source(path)
+        else:
+            raise ValueError('request needs "source" or "path"')
+        name = request.get('name') or path or '<string>'
+        return self.controller.make_stub_string(source, name)
+    #@+node:ekr.20261017099001.6: *3* server.serve_socket & serve_stdio
+    def serve_socket(self, path: str) -> None:  # pragma: no cover
+        """Serve requests on the Unix domain socket at path until shutdown."""
+        import socketserver
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self) -> None:
+                for line in self.rfile:
+                    if line.strip():
+                        response = server.handle_line(line.decode('utf-8'))
+                        self.wfile.write(response.encode('utf-8'))
+                    if not server.running:
+                        break
+
+        if os.path.exists(path):
+            import stat
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                print('--socket: not a socket: %s' % path)
+                print('exiting')
+                sys.exit(1)
+            os.remove(path)  # A socket left by a server that crashed.
+        with socketserver.UnixStreamServer(path, Handler) as unix_server:
+            try:
+                while self.running:
+                    unix_server.handle_request()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(path)
+
+    def serve_stdio(self, stdin: Any=None, stdout: Any=None) -> None:
+        """Serve requests from stdin, writing responses to stdout, until shutdown or end of file."""
+        stdin = stdin or sys.stdin
+        stdout = stdout or sys.stdout
+        try:
+            for line in stdin:
+                if line.strip():
+                    stdout.write(self.handle_line(line))
+                    stdout.flush()
+                if not self.running:
+                    break
+        except KeyboardInterrupt:  # pragma: no cover
+            pass
+    #@-others
 #@+node:ekr.20160318141204.169: ** class StubTraverser (ast.NodeVisitor)
 class StubTraverser(ast.NodeVisitor):
     """
@@ -2227,7 +3492,7 @@ class StubTraverser(ast.NodeVisitor):
         self.class_defs_count = 0
             # The number of defs seen for this class.
         self.context_stack: List[str] = []
-        sf = StubFormatter(controller=controller, traverser=self)
+        self.stub_formatter = sf = StubFormatter(controller=controller, traverser=self)
         self.format = sf.format
         self.arg_format = AstArgFormatter().format
         self.level = 0
@@ -2238,12 +3503,14 @@ class StubTraverser(ast.NodeVisitor):
         self.stubs_dict: Dict[str, Stub] = {}
             # Keys are stub.full_name's.  Values are stubs.
         self.warn_list: List[str] = []
+        self.written: Optional[bool] = None  # Set by write_stub_file.
         # Copies of controller ivars...
         self.output_fn = x.output_fn
         self.overwrite = x.overwrite
         self.prefix_lines = x.prefix_lines
         self.silent = x.silent
         self.regex_patterns = x.regex_patterns
+        self.time_stamp_flag = x.time_stamp_flag
         self.update_flag = x.update_flag
         self.trace_matches = x.trace_matches
         self.trace_patterns = x.trace_patterns
@@ -2266,6 +3533,30 @@ class StubTraverser(ast.NodeVisitor):
             print('%20s: ignoring duplicate entry for %s' % (g_input_file_name, key))  # pragma: no cover
         else:
             d[key] = stub
+    #@+node:ekr.20261017101007.1: *3* st.generic_visit
+    # Only Return, ClassDef and FunctionDef nodes matter, and they appear only
+    # in statement lists. Statement-list fields, in _fields order, per class.
+    statement_fields_dict: Dict[type, Tuple[str, ...]] = {}
+    statement_list_names = frozenset(('body', 'cases', 'finalbody', 'handlers', 'orelse'))
+
+    def generic_visit(self, node: Node) -> None:
+        """
+        Visit the statements in node's statement lists: the bodies of
+        modules, defs, compound statements, except handlers and match
+        cases. Never visit expressions: they can not contain stubs.
+        """
+        fields = self.statement_fields_dict.get(node.__class__)
+        if fields is None:
+            if isinstance(node, ast.expr):
+                fields = ()
+            else:
+                fields = tuple(z for z in node._fields if z in self.statement_list_names)
+            self.statement_fields_dict[node.__class__] = fields
+        for field in fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                for z in value:
+                    self.visit(z)
     #@+node:ekr.20160318141204.172: *3* st.indent & out
     def indent(self, s: str) -> str:
         """Return s, properly indented."""
@@ -2282,32 +3573,85 @@ class StubTraverser(ast.NodeVisitor):
         else:
             print(s)
     #@+node:ekr.20160318141204.173: *3* st.run (main line) & helpers
-    def run(self, node: Node) -> None:  # pragma: no cover
-        """StubTraverser.run: write the stubs in node's tree to self.output_fn."""
+    def run(self, node: Node) -> Optional[str]:  # pragma: no cover
+        """
+        StubTraverser.run: write the stubs in node's tree to self.output_fn.
+
+        Return the stubs (without the time stamp) or None if run could not
+        write self.output_fn. self.written tells whether run wrote the file.
+        """
         fn = self.output_fn
-        dir_ = os.path.dirname(fn)
-        if os.path.exists(fn) and not self.overwrite:
-            print('file exists: %s' % fn)
-            return
-        if dir_ and not os.path.exists(dir_):
-            print('output directory not not found: %s' % dir_)
-            return
+        if not self.check_output_fn(fn):
+            return None
+        stubs = self.make_stubs(node, update_fn=fn if self.update_flag else None)
+        # Write the file.
+        self.write_stub_file(fn, stubs)
+        return stubs
+    #@+node:ekr.20261017098001.1: *4* st.make_stubs
+    def make_stubs(self, node: Node, update_fn: str=None) -> str:
+        """
+        Return the stubs in node's tree, without a time stamp.
+
+        If update_fn is given, merge the stubs with those in the stub file
+        update_fn. Otherwise, don't touch the file system.
+        """
         # Create parent_stub.out_list.
         self.parent_stub = Stub(kind='root', name='<new-stubs>')
         for z in self.prefix_lines or []:
             self.parent_stub.out_list.append(z)
         self.visit(node)
-        if self.update_flag:
-            self.parent_stub = self.update(fn, new_root=self.parent_stub)
-        # Output the stubs.
-        self.output_file = open(fn, 'w')  # type:ignore
-        self.output_time_stamp()
+        self.report_memo()
+        new_root = self.parent_stub
+        if update_fn:
+            self.parent_stub = self.update(update_fn, new_root=new_root)
+        # Format the stubs.
+        self.output_file = io.StringIO()
         self.output_stubs(self.parent_stub)
-        self.output_file.close()  # type:ignore
+        stubs = self.output_file.getvalue()
         self.output_file = None
+        self.release_stubs(new_root, self.parent_stub)
+        return stubs
+    #@+node:ekr.20261017101006.2: *4* st.report_memo
+    def report_memo(self) -> None:
+        """Report the hits of --memoize for --profile and --verbose."""
+        sf = self.stub_formatter
+        if sf.memo is None:
+            return
+        hits, lookups = sf.memo_hits, sf.memo_hits + sf.memo_misses
+        if self.controller.profiler:
+            self.controller.profiler.add_memo_stats(hits, lookups)
+        if self.verbose:  # pragma: no cover
+            rate = 100.0 * hits / lookups if lookups else 0.0
+            print(f"memo: {hits} hits in {lookups} lookups ({rate:.0f}%) {g_input_file_name}")
+    #@+node:ekr.20261017101003.1: *4* st.release_stubs
+    def release_stubs(self, *roots: Stub) -> None:
+        """
+        Release the stub trees and the ast nodes of the file just formatted.
+
+        Parent and child links form reference cycles, which only the garbage
+        collector would free. Break the cycles so that reference counting
+        frees each file's stubs at once.
+        """
         self.parent_stub = None
-        if self.verbose:
-            print('wrote: %s' % fn)
+        self.returns = []
+        self.stubs_dict = {}
+        stack = [z for z in roots if z]
+        while stack:
+            stub = stack.pop()
+            stack.extend(stub.children)
+            stub.children = []
+            stub.parent = None
+    #@+node:ekr.20261017091003.1: *4* st.check_output_fn
+    def check_output_fn(self, fn: str) -> bool:  # pragma: no cover
+        """Return True if run may write the stub file fn."""
+        dir_ = os.path.dirname(fn)
+        if not self.overwrite and os.path.exists(fn):
+            print('file exists: %s' % fn)
+            return False
+        if dir_ and not self.controller.is_directory(dir_):
+            print('output directory not not found: %s' % dir_)
+            return False
+        return True
     #@+node:ekr.20160318141204.174: *4* st.output_stubs
     def output_stubs(self, stub: Stub) -> None:
         """Output this stub and all its descendants."""
@@ -2320,12 +3664,80 @@ class StubTraverser(ast.NodeVisitor):
         # Recursively print all children.
         for child in stub.children:
             self.output_stubs(child)
-    #@+node:ekr.20160318141204.175: *4* st.output_time_stamp
+    #@+node:ekr.20160318141204.175: *4* st.output_time_stamp & helpers
     def output_time_stamp(self) -> None:
         """Put a time-stamp in the output file."""
         if self.output_file:
-            self.output_file.write('# make_stub_files: %s\n' %
-                time.strftime("%a %d %b %Y at %H:%M:%S"))
+            self.output_file.write(self.get_time_stamp())
+
+    def get_source_date_epoch(self) -> Optional[int]:
+        """
+        Return the time in the SOURCE_DATE_EPOCH environment variable,
+        or None. See https://reproducible-builds.org/specs/source-date-epoch/
+        """
+        try:
+            return int(os.environ['SOURCE_DATE_EPOCH'])
+        except (KeyError, ValueError):
+            return None
+
+    def get_time_stamp(self) -> str:
+        """
+        Return the time-stamp line, or '' for --no-time-stamp.
+
+        The time is the SOURCE_DATE_EPOCH (in UTC), if given, or the time of day.
+        """
+        if not self.time_stamp_flag:
+            return ''
+        epoch = self.get_source_date_epoch()
+        t = time.localtime() if epoch is None else time.gmtime(epoch)
+        return '# make_stub_files: %s\n' % time.strftime("%a %d %b %Y at %H:%M:%S", t)
+
+    def split_time_stamp(self, s: str) -> Tuple[str, str]:
+        """Return (the time-stamp line or '', the rest of s)."""
+        if s.startswith('# make_stub_files:'):
+            i = s.find('\n')
+            return (s[: i + 1], s[i + 1 :]) if i > -1 else (s, '')
+        return '', s
+    #@+node:ekr.20261017091005.1: *4* st.write_stub_file & helper
+    def write_stub_file(self, fn: str, stubs: str) -> bool:  # pragma: no cover
+        """
+        Write a time stamp and the stubs to fn, unless fn already contains
+        them. Write atomically.
+
+        Set self.written and return True if fn was written.
+        """
+        s = self.get_time_stamp() + stubs
+        if self.is_unchanged(fn, s):
+            self.written = False
+            if self.verbose:
+                print('unchanged: %s' % fn)
+        else:
+            atomic_write(fn, s)
+            self.written = True
+            if self.verbose:
+                print('wrote: %s' % fn)
+        return self.written
+
+    def is_unchanged(self, fn: str, s: str) -> bool:
+        """
+        Return True if the stub file fn already contains s, a time stamp
+        and stubs.
+
+        Unless SOURCE_DATE_EPOCH pins the time, ignore the times in the
+        time stamps: only the stubs matter.
+        """
+        try:
+            with open(fn, 'r') as f:
+                old_s = f.read()
+        except (OSError, UnicodeDecodeError):
+            return False
+        if old_s == s:
+            return True
+        if self.get_source_date_epoch() is not None:
+            return False
+        old_stamp, old_stubs = self.split_time_stamp(old_s)
+        new_stamp, new_stubs = self.split_time_stamp(s)
+        return bool(old_stamp) == bool(new_stamp) and old_stubs == new_stubs
     #@+node:ekr.20160318141204.176: *4* st.update & helpers
     def update(self, fn: str, new_root: Stub, contents: str=None, silent: bool=False) -> Stub:
         """
@@ -2340,6 +3752,9 @@ class StubTraverser(ast.NodeVisitor):
             s = contents  # For testing
         else:
             s = self.get_stub_file(fn)  # pragma: no cover
+        if s:
+            # Don't add the old time stamp to the new stubs.
+            s = self.split_time_stamp(s)[1]
         if not s or not s.strip():
             return new_root  # pragma: no cover
         if '\t' in s:  # pragma: no cover
@@ -2363,13 +3778,13 @@ class StubTraverser(ast.NodeVisitor):
     #@+node:ekr.20160318141204.177: *5* st.get_stub_file
     def get_stub_file(self, fn: str) -> Optional[str]:  # pragma: no cover
         """Read the stub file into s."""
-        if os.path.exists(fn):
-            try:
-                return open(fn, 'r').read()
-            except Exception:
-                print('--update: error reading %s' % fn)
-                return None
-        print('--update: not found: %s' % fn)
+        try:
+            with open(fn, 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            print('--update: not found: %s' % fn)
+        except Exception:
+            print('--update: error reading %s' % fn)
         return None
     #@+node:ekr.20160318141204.178: *5* st.parse_stub_file
     def parse_stub_file(self, s: str, root_name: str) -> Tuple[Dict[str, Stub], Stub]:
@@ -2431,7 +3846,11 @@ class StubTraverser(ast.NodeVisitor):
         - new_stubs is a list of Stubs from the .py file.
         - old_root is the root of the stubs from the .pyi file.
         - new_root is the root of the stubs from the .py file.
+
+        Stubs match if their (full_name, kind) keys match. Indexing the old
+        tree by these keys makes the merge linear in the number of stubs.
         """
+        old_d = self.index_stubs(old_root)
         # Part 1: Delete old stubs do *not* exist in the *new* tree.
         aList = self.check_delete(new_stubs, old_root, new_root, trace)
             # Checks that all ancestors of deleted nodes will be deleted.
@@ -2439,28 +3858,32 @@ class StubTraverser(ast.NodeVisitor):
             # Sort old stubs so that children are deleted before parents.
         for stub in aList:
             if trace: g.trace('deleting  %s' % stub)  # type:ignore
-            parent = self.find_parent_stub(stub, old_root) or old_root
+            parent = old_d.get(self.stub_key(stub.parent)) or old_root
             parent.children.remove(stub)
-            assert not self.find_stub(stub, old_root), stub
+            old_d.pop(self.stub_key(stub), None)
         # Part 2: Insert new stubs that *not* exist in the *old* tree.
-        aList = [z for z in new_stubs if not self.find_stub(z, old_root)]
+        aList = [z for z in new_stubs if self.stub_key(z) not in old_d]
         aList = self.sort_stubs_by_hierarchy(aList)
             # Sort new stubs so that parents are created before children.
         for stub in aList:
+            if self.stub_key(stub) in old_d:
+                continue  # Inserted with its parent.
             if trace: g.trace('inserting %s' % stub)  # type:ignore
-            parent = self.find_parent_stub(stub, old_root) or old_root
+            parent = old_d.get(self.stub_key(stub.parent)) or old_root
             parent.children.append(stub)
-            assert self.find_stub(stub, old_root), stub
+            self.index_stubs(stub, old_d)
     #@+node:ekr.20160318141204.180: *6* st.check_delete
     def check_delete(self, new_stubs: List[Stub], old_root: Stub, new_root: Stub, trace: bool) -> List[Stub]:
         """Return a list of nodes that can be deleted."""
         old_stubs = self.flatten_stubs(old_root)
         old_stubs.remove(old_root)
-        aList = [z for z in old_stubs if z not in new_stubs]
+        new_keys = set(self.stub_key(z) for z in new_stubs)
+        aList = [z for z in old_stubs if self.stub_key(z) not in new_keys]
         if trace:  # pragma: no cover
             dump_list('old_stubs', old_stubs)
             dump_list('new_stubs', new_stubs)
             dump_list('to-be-deleted stubs', aList)
+        delete_keys = set(self.stub_key(z) for z in aList)
         delete_list = []
         # Check that all parents of to-be-delete nodes will be deleted.
         for z in aList:
@@ -2473,7 +3896,7 @@ class StubTraverser(ast.NodeVisitor):
                 elif z == old_root:
                     delete_list.append(z1)
                     break
-                elif z not in aList:  # pragma: no cover
+                elif self.stub_key(z) not in delete_keys:  # pragma: no cover
                     g.trace("can not delete %s because of %s" % (z1, z))  # type:ignore
                     break
             else:  # pragma: no cover
@@ -2507,25 +3930,32 @@ class StubTraverser(ast.NodeVisitor):
             stub2 = self.find_stub(stub, child)
             if stub2: return stub2
         return None
+    #@+node:ekr.20261017097001.1: *6* st.index_stubs & stub_key
+    def index_stubs(self, root: Stub, d: Dict[Tuple[str, str], Stub]=None) -> Dict[Tuple[str, str], Stub]:
+        """
+        Add all stubs in root's tree to d, a dict whose keys are stub keys.
+        Like find_stub, prefer the first matching stub in outline order.
+        Return d.
+        """
+        if d is None:
+            d = {}
+        stack = [root]
+        while stack:
+            stub = stack.pop()
+            d.setdefault(self.stub_key(stub), stub)
+            stack.extend(reversed(stub.children))
+        return d
+
+    def stub_key(self, stub: Optional[Stub]) -> Optional[Tuple[str, str]]:
+        """Return the key of a stub. Stubs are equal if their keys are equal."""
+        return (stub.full_name, stub.kind) if stub else None
     #@+node:ekr.20160318141204.184: *6* st.sort_stubs_by_hierarchy
     def sort_stubs_by_hierarchy(self, stubs1: List[Stub]) -> List[Stub]:
         """
         Sort the list of Stubs so that parents appear before all their
-        descendants.
-        """
-        stubs, result = stubs1[:], []
-        for i in range(50):
-            if stubs:
-                # Add all stubs with i parents to the results.
-                found = [z for z in stubs if z.level() == i]
-                result.extend(found)
-                for z in found:
-                    stubs.remove(z)
-            else:
-                return result
-        # Abort the merge.
-        g.trace('can not happen: unbounded stub levels.')  # type:ignore # pragma: no cover
-        return []  # pragma: no cover
+        descendants. The sort is stable.
+        """
+        return sorted(stubs1, key=lambda z: z.level())
     #@+node:ekr.20160318141204.185: *5* st.trace_stubs
     def trace_stubs(self,
         stub: Stub, aList: List[str]=None, header: str=None, level: int=-1,
@@ -2658,14 +4088,21 @@ class StubTraverser(ast.NodeVisitor):
     def format_returns(self, node: Node) -> str:
         """
         Calculate the return type:
+        - Return the existing annotation if the def is fully annotated.
         - Return None if there are no return statements.
         - Patterns in [Def Name Patterns] override all other patterns.
         - Otherwise, return a list of return values.
+
+        format_return_expressions formats the raw (unreduced) return
+        expressions only if it needs them.
         """
+        # Step 0: Fast path: the annotations are the signature.
+        parent = self.parent_stub and self.parent_stub.parent
+        if self.is_annotated(node, in_class=bool(parent and parent.kind == 'class')):
+            empty = not any(isinstance(z, ast.FunctionDef) for z in node.body)
+            tail = ': ...' if empty else ':'
+            return self.raw_format(node.returns) + tail
         name = self.get_def_name(node)
-        raw = [self.raw_format(z) for z in self.returns]
-        # Allow StubFormatter.do_Return to do the hack.
-        r = [self.format(z) for z in self.returns]
         # Step 1: Return None if there are no return statements.
         if not [z for z in self.returns if z.value is not None]:  # type:ignore
             empty = not any(isinstance(z, ast.FunctionDef) for z in node.body)
@@ -2676,24 +4113,27 @@ class StubTraverser(ast.NodeVisitor):
             found, s = pattern.match(name)
             if found:
                 return s + ': ...'
+        # Allow StubFormatter.do_Return to do the hack.
+        r = [self.format(z) for z in self.returns]
         # Step 3: remove recursive calls.
-        raw, r = self.remove_recursive_calls(name, raw, r)
+        returns, r = self.remove_recursive_calls(name, self.returns, r)
         # Step 4: Calculate return types.
-        return self.format_return_expressions(node, name, raw, r)
+        return self.format_return_expressions(node, name, returns, r)
     #@+node:ekr.20160318141204.191: *5* st.format_return_expressions
     def format_return_expressions(self,
-        node: Node, name: str, raw_returns: List[Any], reduced_returns: List[Any]
+        node: Node, name: str, returns: List[Node], reduced_returns: List[Any]
     ) -> str:
         """
-        aList is a list of maximally reduced return expressions.
-        For each expression e in Alist:
+        returns is a list of ast.Return nodes.
+        reduced_returns is a list of maximally reduced return expressions.
+        For each expression e in reduced_returns:
         - If e is a single known type, add e to the result.
         - Otherwise, add Any # e to the result.
         Return the properly indented result.
         """
-        assert len(raw_returns) == len(reduced_returns)
+        assert len(returns) == len(reduced_returns)
         lws = '\n' + ' ' * 4
-        n = len(raw_returns)
+        n = len(returns)
         known = all(is_known_type(e) for e in reduced_returns)
         empty = not any(isinstance(z, ast.FunctionDef) for z in node.body)
         tail = ': ...' if empty else ':'
@@ -2702,7 +4142,8 @@ class StubTraverser(ast.NodeVisitor):
             # First, generate the return lines.
             aList = []
             for i in range(n):
-                e, raw = reduced_returns[i], raw_returns[i]
+                # Format the raw return expression only when needed.
+                e, raw = reduced_returns[i], self.raw_format(returns[i])
                 known2 = ' ' if is_known_type(e) else '?'
                 aList.append('# %s %s: %s' % (' ', i, raw.rstrip()))
                 aList.append('# %s %s: return %s' % (known2, i, e))
@@ -2714,6 +4155,27 @@ class StubTraverser(ast.NodeVisitor):
             return 'Any' + tail + results
         s = reduce_types(reduced_returns, name=name, trace=self.trace_reduce)
         return s + tail
+    #@+node:ekr.20261017101008.1: *5* st.is_annotated
+    def is_annotated(self, node: Node, in_class: bool=False) -> bool:
+        """
+        Return True if the def has a return annotation and all its args,
+        except self, are annotated. Such defs need no type inference.
+
+        in_class is True if the def is a method. The first positional arg of
+        a method (self, cls, etc.) need not be annotated, unless the method
+        is a staticmethod.
+        """
+        if node.returns is None:
+            return False
+        args = node.args
+        positional = getattr(args, 'posonlyargs', []) + args.args
+        if in_class and positional and not any(
+            isinstance(z, ast.Name) and z.id == 'staticmethod' for z in node.decorator_list
+        ):
+            positional = positional[1:]
+        aList = positional + args.kwonlyargs
+        aList.extend(z for z in (args.vararg, args.kwarg) if z)
+        return all(z.annotation is not None or z.arg == 'self' for z in aList)
     #@+node:ekr.20160318141204.192: *5* st.get_def_name
     def get_def_name(self, node: Node) -> str:
         """Return the representaion of a function or method name."""
@@ -2726,934 +4188,29 @@ class StubTraverser(ast.NodeVisitor):
             name = node.name  ###
         return name
     #@+node:ekr.20160318141204.193: *5* st.remove_recursive_calls
-    def remove_recursive_calls(self, name: str, raw: List[str], reduced: List[str]) -> Tuple[Any, Any]:
-        """Remove any recursive calls to name from both lists."""
+    def remove_recursive_calls(self, name: str, returns: List[Node], reduced: List[str]) -> Tuple[Any, Any]:
+        """
+        Remove any recursive calls to name from both lists.
+        returns is a list of ast.Return nodes.
+        reduced is the list of the corresponding reduced expressions.
+        """
         # At present, this works *only* if the return is nothing but the recursive call.
-        assert len(raw) == len(reduced)
+        assert len(returns) == len(reduced)
         pattern = Pattern('%s(*)' % name)
         n = len(reduced)
-        raw_result, reduced_result = [], []
+        returns_result, reduced_result = [], []
         for i in range(n):
             if pattern.match_entire_string(reduced[i]):
                 pass  # pragma: no cover
             else:
-                raw_result.append(raw[i])
+                returns_result.append(returns[i])
                 reduced_result.append(reduced[i])
-        return raw_result, reduced_result
+        return returns_result, reduced_result
     #@+node:ekr.20160318141204.194: *3* st.visit_Return
     def visit_Return(self, node: Node) -> None:
         self.returns.append(node)
             # New: return the entire node, not node.value.
     #@-others
-#@+node:ekr.20210803055042.1: ** class TestMakeStubFiles(unittest.TestCase)
-class TestMakeStubFiles(unittest.TestCase):  # pragma: no cover
-    """Unit tests for make_stub_files.py"""
-    #@+others
-    #@+node:ekr.20210805091045.1: *3* test class ReduceTypes
-    #@+node:ekr.20210808033520.1: *4* test_rt_is_known_type
-    def test_rt_is_known_type(self) -> None:
-        table = (
-            ('None', True),
-            ('(xxx)', False),
-            ('str(xxx)', True),
-            ('[str]', True),
-            ('{whatever}', True),
-        )
-        for s, expected in table:
-            result = ReduceTypes().is_known_type(s)
-            self.assertEqual(result, expected, msg=repr(s))
-    #@+node:ekr.20210804105256.1: *4* test_rt_reduce_numbers
-    def test_rt_reduce_numbers(self) -> None:
-        a, c, f, i, l, n = ('Any', 'complex', 'float', 'int', 'long', 'number')
-        table = (
-            ([i,i],     [i]),
-            ([i],       [i]),
-            ([f, i],    [f]),
-            ([c, i],    [c]),
-            ([l, a],    [a, l]),
-        )
-        for aList, expected in table:
-            got = ReduceTypes().reduce_numbers(aList)
-            self.assertEqual(expected, got, msg=repr(aList))
-    #@+node:ekr.20210804111613.1: *4* test_rt_reduce_types
-    def test_rt_reduce_types(self) -> None:
-
-        a, c, f, i, l, n = ('Any', 'complex', 'float', 'int', 'long', 'number')
-        none = 'None'
-        x = 'xyzzy'
-        y = 'pdq'
-        table = (
-            ([i,i],         i),
-            ([i],           i),
-            ([f, i],        f),
-            ([c, i],        c),
-            ([l, a],        'Union[Any, long]'),
-            # Handle None
-            ([None],        none),
-            ([None, None],  none),
-            ([None, a, c],  'Optional[Union[Any, complex]]'),
-            # Handle unknown types, and special cases
-            ([i, x],        'Union[Any, int]'),
-            ([None, x],     'Optional[Any]'),
-            ([none, x],     'Optional[Any]'),
-            (['', x],       'Optional[Any]'),
-            ([none, x, c],  'Optional[Union[Any, complex]]'),
-            ([x, y],        'Any'),
-            # Collection merging.  More could be done...
-            (['Dict[int, str]', 'Dict[Any, str]'],          'Union[Dict[Any, str], Dict[int, str]]'),
-            (['List[int, str]', 'List[Any, str]'],          'Union[List[Any, str], List[int, str]]'),
-            (['Union[int, str]', 'Union[Any, str]'],        'Union[Union[Any, str], Union[int, str]]'),
-            (['Union[int, str]', 'int', 'Union[Any, str]'], 'Union[Union[Any, str], Union[int, str], int]'),
-            (['Tuple[xyz, pdq]'],                           'Tuple[Any, Any]'),
-        )
-        for aList, expected in table:
-            # Call the global function for better coverage.
-            got = reduce_types(aList)  # type:ignore 
-            self.assertEqual(expected, got, msg=repr(aList))
-    #@+node:ekr.20210804111803.1: *4* test_rt_split_types
-    def test_rt_split_types(self) -> None:
-        table = (
-            ('list',                    ['list']),
-            ('List[a,b]',               ['List[a,b]']),
-            ('List[a,b], List[c,d]',    ['List[a,b]', 'List[c,d]']),
-        )
-        for s, expected in table:
-            got = ReduceTypes().split_types(s)
-            self.assertEqual(expected, got, msg=repr(s))
-    #@+node:ekr.20210805092921.1: *3* test class StubTraverser
-    #@+node:ekr.20210804111915.1: *4* test_st_find
-    def test_st_find(self) -> None:
-
-        s = """\
-    def is_known_type(s: str) -> Union[Any,bool]: ...
-    def main() -> None: ...
-    def merge_types(a1: Any, a2: Any) -> str: ...
-
-    class AstFormatter:
-        def format(self, node: Node) -> Union[Any,str]: ...
-        def visit(self, node: Node) -> str: ...
-        def do_ClassDef(self, node: Node) -> str: ...
-        def do_FunctionDef(self, node: Node) -> str: ...
-    """
-        controller = Controller()
-        st = StubTraverser(controller=controller)
-        d, root = st.parse_stub_file(s, root_name='<root>')  # Root *is* used below.
-        if 0:
-            print(st.trace_stubs(root, header='root'))
-        stub1 = Stub(kind='class', name='AstFormatter')
-        stub2 = Stub(kind='def', name='format', parent=stub1, stack=['AstFormatter'])
-        stub3 = Stub(kind='def', name='helper', parent = stub2, stack=['AstFormatter', 'format'])
-        # stub4 = Stub(kind='def', name='main')
-        for stub in (stub1, stub2, stub3,):  # (stub1, stub2, stub3):
-            found = st.find_stub(stub, root)
-            id_found = found and id(found) or None
-            if 0:
-                print('found  %s => %9s %35s ==> %s' % (id(stub), id_found, stub, found))
-            found = st.find_parent_stub(stub, root)
-            id_found = found and id(found) or None
-            if 0:
-                print('parent %s => %9s %35s ==> %s' % (id(stub), id_found, stub, found))
-    #@+node:ekr.20210804112211.1: *4* test_st_flatten_stubs
-    def test_st_flatten_stubs(self) -> None:
-        s = """\
-        def is_known_type(s: str) -> Union[Any,bool]: ...
-        def main() -> None: ...
-        def merge_types(a1: Any, a2: Any) -> str: ...
-        
-        class AstFormatter:
-            def format(self, node: Node) -> Union[Any,str]: ...
-            def visit(self, node: Node) -> str: ...
-            def do_ClassDef(self, node: Node) -> str: ...
-            def do_FunctionDef(self, node: Node) -> str: ...
-        """
-        controller = Controller()
-        st = StubTraverser(controller=controller)
-        d, root = st.parse_stub_file(s, root_name='<root>')
-        if 0:
-            print(st.trace_stubs(root, header='root'))
-        aList = st.flatten_stubs(root)
-        self.assertTrue(aList)
-        if 0:
-            for i, stub in enumerate(aList):
-                print('%2s %s' % (i, stub))
-        for stub in aList:
-            found = st.find_stub(stub, root)
-            self.assertTrue(found, msg=repr(stub))
-    #@+node:ekr.20210804112405.1: *4* test_st_merge_stubs
-    def test_st_merge_stubs(self) -> None:
-        # To do:
-        # - Test between-stub lines and leading lines.
-        # - Round-trip tests!
-        #@+<< old_stubs >>
-        #@+node:ekr.20210804112405.3: *5* << old_stubs >>
-        old_s = """\
-        def main() -> None: ...
-        def merge_types(a1: Any, a2: Any) -> str: ...
-        def pdb(self) -> None: ...
-        def reduce_types(aList: List[Any], name: str=None, trace: bool=False) -> Any: ...
-        class Pattern(object):
-            def __init__(self, find_s: str, repl_s: str='') -> None: ...
-            def __eq__(self, obj: Any) -> bool: ...
-            def __ne__(self, obj: Any) -> bool: ...
-            def __hash__(self) -> int: ...
-            def __repr__(self) -> str: ...
-            def is_balanced(self) -> bool: ...
-            def is_regex(self) -> Any: ...
-                #   0: return self.find_s.endswith('$')
-                # ? 0: return self.find_s.endswith(str)
-        """
-        #@-<< old_stubs >>
-        #@+<< new_stubs >>
-        #@+node:ekr.20210804112405.4: *5* << new_stubs >>
-        new_s = """\
-        def is_known_type(s: str) -> Union[Any,bool]: ...
-        def main() -> None: ...
-        def merge_types(a1: Any, a2: Any) -> str: ...
-        def pdb(self) -> None: ...
-        def reduce_numbers(aList: List[Any]) -> List[Any]: ...
-        def reduce_types(aList: List[Any], name: str=None, trace: bool=False) -> Any: ...
-
-        class AstFormatter:
-            def format(self, node: Node) -> Union[Any,str]: ...
-            def visit(self, node: Node) -> str: ...
-            def do_ClassDef(self, node: Node) -> str: ...
-            def do_FunctionDef(self, node: Node) -> str: ...
-        """
-        #@-<< new_stubs >>
-        controller = Controller()
-        st = StubTraverser(controller=controller)
-        # dump('old_s', old_s)
-        # dump('new_s', new_s)
-        old_d, old_root = st.parse_stub_file(old_s, root_name='<old-root>')
-        new_d, new_root = st.parse_stub_file(new_s, root_name='<new-root>')
-        if 0:
-            dump_dict('old_d', old_d)
-            dump_dict('new_d', new_d)
-            print(st.trace_stubs(old_root, header='trace_stubs(old_root)'))
-            print(st.trace_stubs(new_root, header='trace_stubs(new_root)'))
-        if 0:  # separate unit test. Passed.
-            aList = st.sort_stubs_by_hierarchy(new_root)
-            dump_list(aList, 'after sort_stubs_by_hierarcy')
-        new_stubs = new_d.values()
-        st.merge_stubs(new_stubs, old_root, new_root, trace=False)  # type:ignore
-        if 0:
-            print(st.trace_stubs(old_root, header='trace_stubs(old_root)'))
-    #@+node:ekr.20210807193409.1: *4* test_st_format_returns
-    def test_st_format_returns(self) -> None:
-        # Create the stubs.
-        tag = 'test_st_format_returns'
-        tests: List[str] = [
-        #@+<< test_st_format_returns tests >>
-        #@+node:ekr.20210807210106.1: *5* << test_st_format_returns tests >>
-        # Test 1:
-        """\
-        def test_1(self):
-            if 1:
-                return True
-            return False
-        """,
-        # Test 2:
-        """\
-        def test_2():
-            return xyzzy
-        """,
-        # Test3:
-        """\
-        def test_2(*args, **kwargs):
-            return args
-        """,
-        #@-<< test_st_format_returns tests >>
-        ]
-        controller=Controller()
-        for i, s in enumerate(tests):
-            for verbose in (True, False):
-                for patterns in ([], [Pattern('test_*')]):
-                    # Instantiate new StubController, to avoid duplicate entries.
-                    st = StubTraverser(controller=controller)
-                    st.def_patterns = patterns  # type:ignore
-                    st.verbose = verbose
-                    test_name = f"test {i}"
-                    source = textwrap.dedent(s)  # type:ignore
-                    d, root = st.parse_stub_file(source, root_name=tag)
-                    node = ast.parse(source, filename=test_name, mode='exec')
-                    st.parent_stub = Stub(kind='root', name=test_name)
-                    st.visit(node)
-    #@+node:ekr.20210805090544.1: *3* test issues...
-    #@+node:ekr.20180901040718.1: *4* test_bug2_empty
-    def test_bug2_empty(self) -> None:
-        # https://github.com/edreamleo/make-stub-files/issues/2
-        tag = 'test_bug2_empty'
-        s = 'class InvalidTag(Exception):\n    pass'
-        controller = Controller()
-        node = ast.parse(s, filename=tag, mode='exec')
-        st = StubTraverser(controller=controller)
-        # From StubTraverser.run.
-        st.parent_stub = Stub(kind='root', name='<new-stubs>')
-        st.visit(node)
-        # Allocate a StringIo file for output_stubs.
-        st.output_file = io.StringIO()
-        st.output_stubs(st.parent_stub)
-        # Test.
-        lines = g.splitLines(st.output_file.getvalue())
-        expected = ['class InvalidTag(Exception): ...\n']
-        self.assertEqual(lines, expected)
-    #@+node:ekr.20180901044640.1: *4* test_bug2_non_empty
-    def test_bug2_non_empty(self) -> None:
-        # https://github.com/edreamleo/make-stub-files/issues/2
-        tag = 'test_bug2_non_empty'
-        s = (
-            'class NonEmptyClass:\n'
-            '\n'
-            '    def spam():\n'
-            '        pass\n'
-        )
-        expected = [
-            'class NonEmptyClass:\n',
-            '    def spam() -> None: ...\n',
-        ]
-        controller = Controller()
-        node = ast.parse(s, filename=tag, mode='exec')
-        st = StubTraverser(controller=controller)
-        # From StubTraverser.run.
-        st.parent_stub = Stub(kind='root', name='<new-stubs>')
-        st.visit(node)
-        # Allocate a StringIo file for output_stubs.
-        st.output_file = io.StringIO()
-        st.output_stubs(st.parent_stub)
-        # Test.
-        lines = g.splitLines(st.output_file.getvalue())
-        self.assertEqual(lines, expected)
-    #@+node:ekr.20180901051603.1: *4* test_bug3
-    def test_bug3(self) -> None:
-        # https://github.com/edreamleo/make-stub-files/issues/3
-        tag = 'test_bug3'
-        s = (
-            'class UnsupportedAlgorithm(Exception):\n'
-            '    def __init__(self, message: Any, reason: Optional[str]=None) -> None:\n'
-            '        pass\n'
-        )
-        expected = [
-            'class UnsupportedAlgorithm(Exception):\n',
-            '    def __init__(self, message: Any, reason: Optional[str]=None) -> None: ...\n',
-        ]
-        controller = Controller()
-        node = ast.parse(s, filename=tag, mode='exec')
-        st = StubTraverser(controller=controller)
-        # From StubTraverser.run.
-        st.parent_stub = Stub(kind='root', name='<new-stubs>')
-        st.visit(node)
-        # Allocate a StringIo file for output_stubs.
-        st.output_file = io.StringIO()
-        st.output_stubs(st.parent_stub)
-        # Test.
-        lines = g.splitLines(st.output_file.getvalue())
-        self.assertEqual(lines, expected)
-    #@+node:ekr.20210805093004.1: *3* test top-level functions
-    #@+node:ekr.20210806153836.1: *4* test_finalize
-    def test_finalize(self) -> None:
-        result = finalize(__file__)
-        self.assertEqual(result, __file__)
-    #@+node:ekr.20210806154007.1: *4* test_is_known_type
-    def test_is_known_type(self) -> None:
-        self.assertTrue(is_known_type('str'))
-    #@+node:ekr.20160207115947.1: *4* test_truncate
-    def test_truncate(self) -> None:
-        table = (
-            ('abc',     'abc'),
-            ('abcd',    'abcd'),
-            ('abcde',   'abcde'),
-            ('abcdef',  'ab...'),
-            ('abcdefg', 'ab...'),
-        )
-        for s1, s2 in table:
-            got = truncate(s1, 5)
-            self.assertEqual(s2, got, msg=f"s1: {s1!r}")
-    #@+node:ekr.20210807133723.1: *3* test_ast_arg_formatter_class
-    def test_ast_arg_formatter_class(self) -> None:
-        formatter = AstArgFormatter()
-        tests = [
-            #@+<< define tests >>
-            #@+node:ekr.20210807133723.2: *4* << define tests >> (test_ast_arg_formatter_class)
-            # Tests are either a single string, or a tuple: (source, expected).
-
-            (
-            """\
-            a = 1
-            b = 2.5
-            c = False
-            d = None
-            """,
-            """\
-            a = int
-            b = float
-            c = bool
-            d = None
-            """,
-            )
-            #@-<< define tests >>
-        ]
-        for i, source_data in enumerate(tests):
-            filename = f"test {i+1}"
-            if isinstance(source_data, str):
-                source = textwrap.dedent(source_data)
-                expected_s = textwrap.dedent(source)
-            else:
-                source, expected = source_data
-                source = textwrap.dedent(source)
-                expected_s = textwrap.dedent(expected)
-            node = ast.parse(source, filename=filename, mode='exec')
-            try:
-                result_s = formatter.format(node)
-            except Exception:
-                self.fail(filename)
-            lines = g.splitLines(result_s)
-            expected_lines = g.splitLines(expected_s)
-            self.assertEqual(expected_lines, lines, msg=filename)
-    #@+node:ekr.20210805090943.1: *3* test_ast_formatter_class
-    def test_ast_formatter_class(self) -> None:
-        formatter = AstFormatter()
-        if 0:  # For debugging.
-            tests = ["""\
-                def yield_test():
-                    yield 1
-                """
-            ]
-        else:
-            tests = [
-            #@+<< define tests >>
-            #@+node:ekr.20210805144859.1: *4* << define tests >> (test_ast_formatter_class)
-            # Tests are either a single string, or a tuple: (source, expected).
-
-            # Test 1. Class.
-            """\
-            class AstFormatter:
-                def format(self, node: Node) -> Union[Any, str]:
-                    pass
-            """,
-            # Test 2: Constant.
-            """\
-            a = 1
-            b = 2.5
-            c = False
-            d = None
-            """,
-            # Test 3: ClassDef
-            (
-            """\
-            @class_decorator
-            class TestClass(str, base2=int):
-                pass
-            """,
-            """\
-            @class_decorator
-            class TestClass(str, base2=int): ...
-                pass
-            """,
-            ),
-            # Test 4: FunctionDef
-            """\
-            @function_decorator
-            def f():
-                pass
-            """,
-            # Test 5: Position-only arg.
-            """\
-            def pos_only_arg(arg, /):
-                pass
-            """,
-            # Test 6: Keyword-only arg.
-            """\
-            def kwd_only_arg(*, arg, arg2=None):
-                pass
-            """,
-            # Test 7: Position-only and keyword-only args.
-            """\
-            def combined_example(pos_only, /, standard, *, kwd_only):
-                pass
-            """,
-            # Test 8: Call.
-            "print(*args, **kwargs)\n",
-            # Test 9: Slices: Python 3.9 does not use ExtSlice.
-            "print(s[0:1:2])\n",
-            # Test 10: Continue.
-            """\
-            while 1:
-                continue
-            """,
-            # Test 11: Delete.
-            "del a\n",
-            # Test 12: ExceptHandler.
-            """\
-            try:
-                pass
-            except Exception as e:
-                print('oops')
-            else:
-                print('else')
-            finally:
-                print('finally')
-            """,
-            # Test 13: ImportFrom.
-            "from a import b as c\n",
-            # Test 14: Nonlocal.
-            """\
-            def nonlocal_test():
-                nonlocal a
-            """,
-            # Test 15: Raise.
-            """\
-            raise Exception('spam', 'eggs')
-            raise
-            """,
-            # Test 16: While.
-            """\
-            while True:
-                print(True)
-            else:
-                print('else')
-            """,
-            # Test 17: With.
-            """\
-            with open(f, 'r') as f:
-                f.read()
-            """,
-            # Test 18: Yield and YieldFrom.
-            """\
-            def yield_test():
-                yield 1
-                yield from z
-                yield
-            """,
-            # Test 19: ImportFrom.
-            "import a.b as c\n",
-            # Test 20: Await.
-            "await abc\n",
-            # Test 21: AsyncFor.
-            """\
-            async for a in b:
-                print('body')
-            else:
-                print('else')
-            """,
-            # Test 22: AsyncFunctiondef.
-            """\
-            @function_decorator
-            async def f1() -> None:
-                pass
-            async def f2():
-                pass
-            """,
-            # Test 23: AsyncWith.
-            """\
-            async with open(f, 'r') as f:
-                f.read()
-            """,
-            # Test 24: DictComp.
-            "a = {a: b for a in c}\n",
-            # Test 25: ListComp..
-            "a2 = [z for z in set(e1, e2)]\n",
-            # Test 26: Set.
-            "a2 = {a,b}\n",
-            # Test 27: SetComp.
-            "a3 = {s for s in [1, 2, 1, 0]}\n",
-            #@-<< define tests >>
-            ]
-        for i, source_data in enumerate(tests):
-            filename = f"test {i+1}"
-            if isinstance(source_data, str):
-                source = textwrap.dedent(source_data)
-                expected_s = textwrap.dedent(source)
-            else:
-                source, expected = source_data
-                source = textwrap.dedent(source)
-                expected_s = textwrap.dedent(expected)
-            node = ast.parse(source, filename=filename, mode='exec')
-            try:
-                result_s = formatter.format(node)
-            except Exception:
-                self.fail(filename)
-            lines = g.splitLines(result_s)
-            expected_lines = g.splitLines(expected_s)
-            self.assertEqual(expected_lines, lines, msg=filename)
-    #@+node:ekr.20210806011736.1: *3* test_ast_formatter_class_on_file
-    def test_ast_formatter_class_on_file(self) -> None:
-        # Use the source of *this* file as a single test.
-        filename = __file__
-        formatter = AstFormatter()
-        with open(filename, 'r') as f:
-            source = f.read()
-        node = ast.parse(source, filename=filename, mode='exec')
-        result_s = formatter.format(node)
-        assert result_s
-    #@+node:ekr.20210808052134.1: *3* test_controller_class
-    def test_controller_class(self) -> None:
-        
-        controller = Controller()
-        # Test is_section_name.
-        for name in controller.section_names:
-            self.assertTrue(controller.is_section_name(f"[{name}]"), msg=name)
-        self.assertFalse(controller.is_section_name('whatever'))
-        # Test find_pattern_ops.
-        directory = os.path.dirname(__file__)
-        controller.config_fn = finalize('make_stub_files.cfg')
-        controller.scan_options()
-        self.assertTrue(controller.parser)  # type:ignore
-    #@+node:ekr.20210805093615.1: *3* test_file_msb
-    def test_file_msb(self) -> None:
-        """Run make_stub_files on itself."""
-        if 1:
-            # This test is was only briefly useful.
-            # In general, this test masks proper testing.
-            self.skipTest('Prevents proper coverage data')
-        elif 1:
-            # Actually creates stubs.
-            # f"python {msf} -c {cfg} -o -v {src}"
-            directory = os.path.dirname(__file__)
-            config_fn = finalize('make_stub_files.cfg')
-            sys.argv = ['python', '-c', config_fn, '-o', '-v', __file__]
-            main()
-        else: # Works: (Like main function)
-            controller = Controller()
-            # Set ivars instead of calling scan_command_line.
-            fn = __file__
-            directory = os.path.dirname(__file__)
-            controller.config_fn = finalize(os.path.join(directory, 'make_stub_files.cfg'))
-            assert os.path.exists(controller.config_fn), controller.config_fn
-            controller.overwrite = True
-            # Go!
-            controller.scan_options()
-            for fn in controller.files:
-                controller.make_stub_file(fn)
-    #@+node:ekr.20210804103146.1: *3* test_pattern_class
-    def test_pattern_class(self) -> None:
-        table = (
-            # s,  Pattern.find_s, Pattern.repl_s, expected
-            ('aabbcc', '(a+)(b+)(c+)$', r'\3\2\1', 'ccbbaa'),
-            ('[str]', r'\[str\]$', 'xxx', 'xxx'), # Guido bug.
-            ('s3', r's[1-3]?\b$', 'str', 'str'), # lengthening bug.
-            ('s', 's', 'str', 'str'),
-            ('abc', 'abc', 'ABC', 'ABC'),
-            ('str(str)', 'str(*)', 'str', 'str'),
-            ('[whatever]', '[*]', 'List[*]', 'List[whatever]'), # * on the RHS.
-            ('(int,str)', '(*)', 'Tuple[*]', 'Tuple[int,str]'), # Guido bug 2.
-            ('abcxyz', 'abc*', 'xxx', 'xxx'), # New test for trailing *.
-            ('list(self.regex.finditer(str))','list(*)','List[*]',
-             'List[self.regex.finditer(str)]'),
-        )
-        for s, find, repl, expected in table:
-            pattern = Pattern(find, repl)
-            result = pattern.match_entire_string(s)
-            self.assertTrue(result, msg=repr(s))
-            aList = pattern.all_matches(s)
-            self.assertTrue(len(aList) == 1, msg=repr(aList))
-            found, s2 = pattern.match(s)
-            self.assertTrue(found, msg=f"after pattern.match({s!r})")
-            assert s2 == expected, (s, pattern, 'expected', expected, 'got', s2)
-        p1 = Pattern('abc','xyz')
-        p2 = Pattern('abc','xyz')
-        p3 = Pattern('abc','pdq')
-        self.assertEqual(p1, p2)
-        self.assertNotEqual(p1, p3)
-        self.assertNotEqual(p2, p3)
-        aSet = set()
-        aSet.add(p1)
-        self.assertTrue(p1 in aSet)
-        self.assertTrue(p2 in aSet)
-        self.assertFalse(p3 in aSet)
-        self.assertEqual(list(aSet), [p1])
-        self.assertEqual(list(aSet), [p2])
-        aSet.add(p3)
-        self.assertTrue(p1.match_entire_string('abc'))
-        self.assertFalse(p1.match_entire_string('abcx'))
-        # Test pattern.match.
-        p4 = Pattern('[*]', '[*]')
-        self.assertTrue(p4.is_balanced())
-        found, new_s = p4.match('xyzzy')
-        self.assertFalse(found, msg='p4')
-        p5 = Pattern('abc', 'xyz')
-        self.assertFalse(p5.is_balanced())
-        found, new_s = p5.match('xyzzy')
-        self.assertFalse(found, msg='p5')
-        # Test pattern.replace.
-        found, new_s = p5.match('abc')
-        self.assertTrue(found, msg='replace p5')
-        result5 = p5.replace(found, 'ABC')
-        self.assertTrue(result5, 'ABC')
-        p6 = Pattern('list[*]', 'List[*]')
-        found, s = p6.match('list[abc]')
-        self.assertTrue(found, msg='p6')
-        self.assertTrue(p6.all_matches('list[abc]'))
-        for m in reversed(p6.all_matches('list[abc]')):
-            pattern.replace(m, 'list(xyz)')
-    #@+node:ekr.20210804112556.1: *3* test_stub_class
-    def test_stub_class(self) -> None:
-        # Test equality...
-        stub1 = Stub(kind='def', name='foo')
-        stub2 = Stub(kind='class', name='foo')
-        stub3 = Stub(kind='def', name='bar')
-        stub4 = Stub(kind='def', name='foo')
-        stub4.out_list = ['xyzzy']  # Contents of out_list must not affect equality!
-        aList = [stub1, stub3]
-        self.assertNotEqual(stub1, stub2)
-        self.assertNotEqual(stub1, stub3)
-        self.assertEqual(stub1, stub4)
-        self.assertTrue(stub1 in aList)
-        self.assertFalse(stub2 in aList)
-        self.assertTrue(stub3 in aList)
-        # Test __hash__
-        d = {stub1: 'stub1'}
-        self.assertTrue(stub1 in d)
-        self.assertFalse(stub2 in d)
-        # Test parents and level.
-        stub_1 = Stub(kind='def', name='stub_1')
-        stub_2 = Stub(kind='def', name='stub_2', parent=stub_1, stack=['stub_1'])
-        stub_3 = Stub(kind='def', name='stub_3', parent=stub_2, stack=['stub_1', 'stub_2'])
-        self.assertEqual(stub_1.parents(), [], msg=repr(stub_1.parents()))
-        self.assertEqual(stub_2.parents(), ['stub_1'], msg=repr(stub_2.parents()))
-        self.assertEqual(stub_3.parents(), ['stub_1', 'stub_2'], msg=repr(stub_3.parents()))
-        self.assertEqual(stub_1.level(), 0)
-        self.assertEqual(stub_2.level(), 1)
-        self.assertEqual(stub_3.level(), 2)
-    #@+node:ekr.20210807133118.1: *3* test_stub_formatter_class
-    def test_stub_formatter_class(self) -> None:
-        controller = Controller()
-        controller.config_fn = finalize('make_stub_files.cfg')
-        traverser = StubTraverser(controller)
-        formatter = StubFormatter(controller, traverser)
-        #
-        # Part 1: Formatting tests.
-        if 0:  # For debugging.
-            tests = [(
-                "a = ['1', 2]\n",
-                "a = List[str, int]\n",
-            )]
-        else:
-            tests = [
-            #@+<< define tests >>
-            #@+node:ekr.20210807133228.1: *4* << define tests >> (test_stub_formatter_class)
-            # Tests are either a single string, or a tuple: (source, expected).
-
-            # Test 1: Constant.
-            (
-            """\
-            a = 1
-            b = 2.5
-            c = False
-            d = None
-            s = "abc"
-            """,
-            """\
-            a = int
-            b = float
-            c = bool
-            d = None
-            s = str
-            """
-            ),
-            # Test 2: Attribute.
-            "print(a.b)\n",
-            # Test 3: BinOp.
-            (
-            """\
-            print(1 + 2)
-            print(3 + 4.1)
-            print('s' + a)
-            print(a + b)
-            """,
-            """\
-            print(int)
-            print(float)
-            print(str)
-            print(a+b)
-            """,
-            ),
-            # Test 4: Compare
-            (
-            """\
-            print(a in b)
-            """,
-            """\
-            print(bool)
-            """
-            ),
-            # Test 5: Dict
-            (
-            """\
-            a = {}
-            b = {'1': 1}
-            c = dict()
-            """,
-            """\
-            a = Dict
-            b = Dict[str:int]
-            c = Dict
-            """,
-            ),
-            # Test 6: Call.
-            (
-            """\
-            print(*args, **kwargs)
-            print(dict(a, b))
-            """,
-            """\
-            print(*args, **kwargs)
-            print(Dict[a, b])
-            """
-            ),
-            # Test 7: ifExp.
-            (
-            "print(1 if True else 2)\n",
-            "print(int)\n",
-            ),
-            # Test 8: List.
-            (
-            "a = ['1', 2]\n",
-            "a = List[str, int]\n",
-            ),
-            # Test 9: Tuple.
-            (
-            "a = ('1', 2)\n",
-            "a = Tuple[str, int]\n",
-            ),
-            # Test 10: UnaryOp.
-            (
-            """\
-            a = -b
-            c = not d
-            """,
-            """\
-            a = -b
-            c = bool
-            """
-            ),
-            # Test 11: Subscript.
-            (
-            "a = b[1:2:3]\n",
-            "a = b[int:int:int]\n"
-            ),
-            # Test 12: Return.
-            (
-            # sf.Return only returns the return expression(!)
-            "return 99\n",
-            "int",
-            )
-            #@-<< define tests >>
-            ]
-        for i, source_data in enumerate(tests):
-            filename = f"test {i+1}"
-            if isinstance(source_data, str):
-                source = textwrap.dedent(source_data)
-                expected_s = textwrap.dedent(source)
-            else:
-                source, expected = source_data
-                source = textwrap.dedent(source)
-                expected_s = textwrap.dedent(expected)
-            node = ast.parse(source, filename=filename, mode='exec')
-            try:
-                result_s = formatter.format(node)
-            except Exception:
-                self.fail(filename)
-            lines = g.splitLines(result_s)
-            expected_lines = g.splitLines(expected_s)
-            self.assertEqual(expected_lines, lines, msg=filename)
-        #
-        # Part 2: Scan the default options
-        directory = os.path.dirname(__file__)
-        controller.scan_options()
-        #
-        # Part 3: test match_all.
-        source = '("a", "b")\n'
-        root = ast.parse(source, filename='match-all', mode='exec')
-        for node in ast.walk(root):  # type:ignore
-            formatter.match_all(node, 'hash(a)', trace=False)
-    #@+node:ekr.20210808063828.1: *3* test_stub_traverser_class
-    def test_stub_traverser_class(self) -> None:
-        tag = 'test_stub_traverser_class'
-        controller = Controller()
-        st = StubTraverser(controller)
-        # Part 1: test st.visit_*.
-        source = textwrap.dedent("""\
-            class Test(base1, base2=None):
-                def test(self):
-                    if 1:
-                        return True
-            """)
-        expected_output = textwrap.dedent("""\
-            class Test(base1):
-                def test(self) -> bool: ...
-            """)
-        node = ast.parse(source, filename=tag, mode='exec')
-        # Like traverser.run, but with a StringIO file.
-        st.output_file = io.StringIO()
-        st.parent_stub = Stub(kind='root', name='<new-stubs>')
-        st.visit(node)
-        st.output_stubs(st.parent_stub)
-        output = st.output_file.getvalue()
-        self.assertEqual(output, expected_output)
-        # Part 2: Test st.munge_arg.
-        st.general_patterns = [Pattern('abc', 'xyz')]
-        table = (
-            ('self', 'self'),
-            ('a:b', 'a:b'),
-            ('abc', 'abc: xyz'),
-            ('xxx', 'xxx: Any'),
-        )
-        for arg, expected in table:
-            got = st.munge_arg(arg)
-            self.assertEqual(expected, got, msg=arg)
-        # Part 3: Test st.output_time_stamp.
-        st.output_file = io.StringIO()
-        st.output_time_stamp()
-        output = st.output_file.getvalue()
-        self.assertTrue(output.startswith('# make_stub_files:'), msg=output)
-        # Part 4: Test st.update. Similar to st.run.
-        st.output_file = io.StringIO()
-        st.parent_stub = Stub(kind='root', name='update-test')
-        parent_stub = st.update(fn='test-update', new_root=st.parent_stub,
-            contents=expected_output, silent=True)
-        st.output_stubs(parent_stub)
-        output = st.output_file.getvalue()
-    #@+node:ekr.20210810104304.1: *3* test_visitors_exist
-    def test_visitors_exist(self):
-        """Ensure that visitors for all ast nodes exist."""
-        import _ast
-        # Compute all fields to BaseTest.
-        aList = sorted(dir(_ast))
-        remove = [
-            'Interactive', 'Suite',  # Not necessary.
-            'AST',  # The base class,
-            # Constants...
-            'PyCF_ALLOW_TOP_LEVEL_AWAIT',
-            'PyCF_ONLY_AST',
-            'PyCF_TYPE_COMMENTS',
-            # New ast nodes for Python 3.8.
-            # We can ignore these nodes because:
-            # 1. ast.parse does not generate them by default.
-            # 2. The type comments are ordinary comments.
-            #    They do not need to be specially synced.
-            # 3. Tools such as black, orange, and fstringify will
-            #    only ever handle comments as comments.
-            'FunctionType', 'NamedExpr', 'TypeIgnore',
-        ]
-        aList = [z for z in aList if not z[0].islower()]
-            # Remove base classes.
-        aList = [z for z in aList
-            if not z.startswith('_') and not z in remove]
-        # Now test them.
-        traverser = AstFormatter()
-        traverser_name = traverser.__class__.__name__
-        errors, nodes, ops = 0, 0, 0
-        for z in aList:
-            if hasattr(traverser, 'do_' + z):
-                nodes += 1
-            elif _op_names.get(z):
-                ops += 1
-            else:  # pragma: no cover
-                errors += 1
-                print(f"Missing visitor: {traverser_name}.{z}")
-        msg = f"{nodes} node types, {ops} op types, {errors} errors"
-        assert not errors, msg
-    #@-others
 #@-others
 g = LeoGlobals()
 g_input_file_name = None
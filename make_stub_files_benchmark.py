@@ -0,0 +1,428 @@
+#@+leo-ver=5-thin
+#@+node:ekr.20261017095001.1: * @file make_stub_files_benchmark.py
+#!/usr/bin/env python
+"""
+Benchmarks for make_stub_files.py.
+
+Time each phase of the stub pipeline separately, on a synthetic corpus and
+on real files, and report the results as JSON.
+
+The phases are:
+
+- config:        Parse the configuration file (Controller.scan_options).
+- patterns:      Controller.make_patterns_dict.
+- parse:         ast.parse.
+- visit:         StubTraverser.visit, excluding the time in ReduceTypes.
+- reduce_types:  ReduceTypes.reduce_types, called during the visit.
+- update:        The --update merge (StubTraverser.update) of the stubs
+                 into a stub file containing the same stubs.
+- output:        StubTraverser.output_stubs.
+
+Each phase runs --repeat times. The report contains the fastest time.
+
+The corpora are:
+
+- synthetic:     Classes containing methods that return a variety of
+                 expressions.
+- binop_chain_100, binop_chain_400:
+                 Functions returning chains of 100 and 400 binary
+                 operations. The cost of formatting a chain should be
+                 linear in its length: compare the two visit times.
+- real:          The files given on the command line, if any.
+
+The "dispatch" entry of each corpus is a microbenchmark of
+AstFormatter.visit: the cost per ast node of AstFormatter.format, using
+the class-level dispatch_dict and using the per-node getattr dispatch of
+earlier versions (GetattrFormatter).
+
+Usage:
+
+    python make_stub_files_benchmark.py [-c FILE] [-n N] [-o FILE]
+        [--compare FILE] [file1, file2, ...]
+
+make_stub_files.py --benchmark runs this module on the files that
+make_stub_files.py would process.
+
+This file is in the public domain.
+"""
+#@+<< imports >>
+#@+node:ekr.20261017095001.2: ** << imports >> (make_stub_files_benchmark.py)
+import argparse
+import ast
+from ast import AST as Node
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import make_stub_files as msf
+except ImportError:  # pragma: no cover
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import make_stub_files as msf
+#@-<< imports >>
+
+Corpus = List[Tuple[str, str]]  # A list of (file name, source).
+
+#@+others
+#@+node:ekr.20261017095001.3: ** top-level functions
+#@+node:ekr.20261017095001.4: *3* function: compare_results
+def compare_results(old: Dict[str, Any], new: Dict[str, Any], threshold: float=0.1) -> List[str]:
+    """
+    Compare two results of Benchmark.run.
+
+    Return a list of messages, one for each phase of each corpus that is
+    more than threshold (a fraction) slower in new than in old.
+    """
+    messages = []
+    for corpus_name, new_corpus in new['corpora'].items():
+        old_corpus = old['corpora'].get(corpus_name)
+        if not old_corpus:
+            continue
+        for phase, t2 in new_corpus['phases'].items():
+            t1 = old_corpus['phases'].get(phase)
+            if t1 and t2 > t1 * (1.0 + threshold):
+                messages.append(
+                    f"{corpus_name}.{phase}: {t1:.4f} sec. -> {t2:.4f} sec. "
+                    f"({100.0 * (t2 - t1) / t1:+.0f}%)")
+    return messages
+#@+node:ekr.20261017095001.5: *3* function: main
+def main(argv: List[str]=None) -> None:  # pragma: no cover
+    """The driver for the stand-alone version of the benchmarks."""
+    description = 'Time the phases of make_stub_files.py.'
+    usage = 'make_stub_files_benchmark.py [options] file1, file2, ...'
+    parser = argparse.ArgumentParser(description=description, usage=usage)
+    add = parser.add_argument
+    add('files', metavar='FILE', type=str, nargs='*',
+        help='the real corpus')
+    add('-c', '--config', dest='fn', metavar='FILE',
+        help='full path to configuration file')
+    add('--compare', dest='compare', metavar='FILE',
+        help='report phases more than 10%% slower than in FILE (a previous report)')
+    add('-n', '--repeat', dest='repeat', metavar='N', type=int, default=3,
+        help='run each phase N times (default 3)')
+    add('-o', '--output', dest='output', metavar='FILE',
+        help='write the JSON report to FILE instead of stdout')
+    args = parser.parse_args(argv)
+    files: List[str] = []
+    for z in args.files:
+        files.extend(glob.glob(msf.finalize(z)))
+    run_benchmark(args.fn and msf.finalize(args.fn), files,
+        repeat=args.repeat, output_fn=args.output, compare_fn=args.compare)
+#@+node:ekr.20261017101013.1: *3* function: letters
+def letters(n: int) -> str:
+    """
+    Return a name for n containing only letters: the --update parser
+    (StubTraverser.parse_stub_file) requires names without digits.
+    """
+    s = ''
+    while True:
+        n, i = divmod(n, 26)
+        s = 'abcdefghijklmnopqrstuvwxyz'[i] + s
+        if not n:
+            return s
+#@+node:ekr.20261017101013.2: *3* function: make_binop_chain_source
+def make_binop_chain_source(n_terms: int=200, n_functions: int=10) -> str:
+    """
+    Return the source of a module containing n_functions functions, each
+    returning a chain of n_terms operands joined by binary operators.
+
+    StubFormatter.do_BinOp once formatted both operands again at every
+    level of the chain, taking time exponential in its depth.
+    """
+    operators = ('+', '-', '*')
+    lines = []
+    for i in range(n_functions):
+        terms = [f"{'ab'[j % 2]}.f_{letters(j)}" for j in range(n_terms)]
+        chain = terms[0] + ''.join(
+            f" {operators[j % len(operators)]} {term}" for j, term in enumerate(terms[1:]))
+        lines.append(f"def chain_{letters(i)}(a, b):")
+        lines.append(f"    return {chain}")
+        lines.append('')
+    return '\n'.join(lines)
+#@+node:ekr.20261017095001.6: *3* function: make_synthetic_source
+def make_synthetic_source(n_classes: int=10, n_methods: int=20) -> str:
+    """
+    Return the source of a module containing n_classes classes, each
+    containing n_methods methods. The methods return a variety of
+    expressions, so that all phases have work to do.
+    """
+    returns = (
+        'None',
+        '0',
+        'a + 1',
+        "'abc' + str(a)",
+        '[a, b]',
+        '{a: b}',
+        'self.helper(a, b=2)',
+        'a if b else None',
+        'len(a) > 0',
+        'x.method(a)[0]',
+    )
+
+    lines = ['import os', '', '']
+    for i in range(n_classes):
+        lines.append(f"class Class_{letters(i)}(object):")
+        lines.append(f"    '''Class {i}.'''")
+        for j in range(n_methods):
+            lines.append(f"    def method_{letters(j)}(self, a, b=None, *args, **kwargs):")
+            lines.append(f"        x = os.path.join(str(a), 'b')")
+            lines.append(f"        if a:")
+            lines.append(f"            return {returns[j % len(returns)]}")
+            lines.append(f"        return {returns[(i + j) % len(returns)]}")
+            lines.append('')
+    return '\n'.join(lines)
+#@+node:ekr.20261017095001.7: *3* function: read_corpus
+def read_corpus(files: List[str]) -> Corpus:
+    """Return the corpus of the given .py files."""
+    corpus = []
+    for fn in files:
+        if fn.endswith('.py') and os.path.exists(fn):
+            with open(fn, 'r', encoding='utf-8') as f:
+                corpus.append((fn, f.read()))
+    return corpus
+#@+node:ekr.20261017095001.8: *3* function: run_benchmark
+def run_benchmark(
+    config_fn: str,
+    files: List[str],
+    repeat: int=3,
+    output_fn: str=None,
+    compare_fn: str=None,
+) -> Dict[str, Any]:  # pragma: no cover
+    """
+    Run the benchmarks on the synthetic corpus and on the given files.
+    Write the JSON report to output_fn or sys.stdout.
+    """
+    corpora = {
+        'synthetic': [(f"synthetic_{i}.py", make_synthetic_source()) for i in range(10)],
+        'binop_chain_100': [('binop_chain_100.py', make_binop_chain_source(n_terms=100))],
+        'binop_chain_400': [('binop_chain_400.py', make_binop_chain_source(n_terms=400))],
+    }
+    real = read_corpus(files)
+    if real:
+        corpora['real'] = real
+    results = Benchmark(config_fn, repeat=repeat).run(corpora)
+    s = json.dumps(results, indent=2, sort_keys=True)
+    if output_fn:
+        with open(output_fn, 'w') as f:
+            f.write(s + '\n')
+    else:
+        print(s)
+    if compare_fn:
+        with open(compare_fn, 'r') as f:
+            old = json.load(f)
+        messages = compare_results(old, results)
+        for message in messages:
+            print(f"slower: {message}", file=sys.stderr)
+        if not messages:
+            print('no regressions', file=sys.stderr)
+    return results
+#@+node:ekr.20261017095001.9: ** class Benchmark
+class Benchmark:
+    """Time the phases of make_stub_files.py on one or more corpora."""
+
+    #@+others
+    #@+node:ekr.20261017095001.10: *3* bench.ctor
+    def __init__(self, config_fn: str=None, repeat: int=3) -> None:
+        """Ctor for Benchmark class."""
+        self.config_fn = config_fn
+        self.repeat = max(1, repeat)
+    #@+node:ekr.20261017095001.11: *3* bench.best_time
+    def best_time(self, function: Callable[[], Any], repeat: int=None) -> Tuple[float, Any]:
+        """
+        Call function() repeat (default self.repeat) times, discarding
+        everything it prints.
+
+        Return (the fastest time, the result of the last call).
+        """
+        best, result = None, None
+        for i in range(repeat or self.repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                t1 = time.perf_counter()
+                result = function()
+                t2 = time.perf_counter()
+            if best is None or t2 - t1 < best:
+                best = t2 - t1
+        return best, result
+    #@+node:ekr.20261017095001.12: *3* bench.make_controller
+    def make_controller(self) -> Tuple[float, float, "msf.Controller"]:
+        """
+        Return (config time, patterns time, controller), where controller
+        is a Controller initialized from self.config_fn.
+        """
+
+        def scan_options() -> msf.Controller:
+            controller = msf.Controller()
+            controller.config_fn = self.config_fn
+            # Time make_patterns_dict separately.
+            controller.make_patterns_dict = lambda: None  # type:ignore
+            controller.scan_options()
+            del controller.make_patterns_dict
+            return controller
+
+        config_time, controller = self.best_time(scan_options)
+        patterns_time, _ = self.best_time(controller.make_patterns_dict)
+        controller.silent = True
+        return config_time, patterns_time, controller
+    #@+node:ekr.20261017095001.13: *3* bench.run
+    def run(self, corpora: Dict[str, Corpus]) -> Dict[str, Any]:
+        """
+        Time all phases on all corpora.
+
+        corpora maps names to corpora. Return a dict suitable for json.dumps.
+        """
+        config_time, patterns_time, controller = self.make_controller()
+        results: Dict[str, Any] = {
+            'version': msf.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': self.repeat,
+            'config_fn': self.config_fn,
+            'config': config_time,
+            'patterns': patterns_time,
+            'corpora': {},
+        }
+        for name, corpus in corpora.items():
+            results['corpora'][name] = self.run_corpus(controller, corpus)
+        return results
+    #@+node:ekr.20261017095001.14: *3* bench.run_corpus & helper
+    def run_corpus(self, controller: "msf.Controller", corpus: Corpus) -> Dict[str, Any]:
+        """Time the per-file phases on one corpus."""
+        phases = dict.fromkeys(('parse', 'visit', 'reduce_types', 'update', 'output'), 0.0)
+        n_lines, update_errors = 0, 0
+        for fn, source in corpus:
+            n_lines += len(source.splitlines())
+            for phase, t in self.run_file(controller, fn, source).items():
+                if t is None:
+                    update_errors += 1
+                else:
+                    phases[phase] += t
+        total = sum(phases.values())
+        return {
+            'dispatch': self.time_dispatch(corpus),
+            'files': len(corpus),
+            'lines': n_lines,
+            'phases': phases,
+            'update_errors': update_errors,
+            'total': total,
+            'files_per_sec': len(corpus) / total if total else 0.0,
+            'lines_per_sec': n_lines / total if total else 0.0,
+        }
+    #@+node:ekr.20261017095001.15: *4* bench.run_file
+    def run_file(self, controller: "msf.Controller", fn: str, source: str) -> Dict[str, Optional[float]]:
+        """
+        Time the per-file phases on one file.
+
+        The time of the update phase is None if the merge fails.
+        """
+        msf.g_input_file_name = os.path.basename(fn)
+        parse_time, tree = self.best_time(lambda: ast.parse(source, filename=fn, mode='exec'))
+        #
+        # Time the visit, separating the time spent in ReduceTypes.
+        reduce_times: List[float] = []
+        reduce_types = msf.ReduceTypes.reduce_types
+
+        def timed_reduce_types(self: msf.ReduceTypes) -> str:
+            t1 = time.perf_counter()
+            try:
+                return reduce_types(self)
+            finally:
+                reduce_times.append(time.perf_counter() - t1)
+
+        def visit() -> msf.StubTraverser:
+            st = msf.StubTraverser(controller=controller)
+            st.parent_stub = msf.Stub(kind='root', name='<new-stubs>')
+            st.parent_stub.out_list.extend(st.prefix_lines or [])
+            st.visit(tree)
+            return st
+
+        # Report both times from the fastest run.
+        visit_time, reduce_time = None, 0.0
+        msf.ReduceTypes.reduce_types = timed_reduce_types  # type:ignore
+        try:
+            for i in range(self.repeat):
+                reduce_times.clear()
+                t, st = self.best_time(visit, repeat=1)
+                if visit_time is None or t < visit_time:
+                    visit_time, reduce_time = t, sum(reduce_times)
+        finally:
+            msf.ReduceTypes.reduce_types = reduce_types  # type:ignore
+        #
+        # Time the output.
+
+        def output() -> str:
+            st.output_file = io.StringIO()
+            st.output_stubs(st.parent_stub)
+            s = st.output_file.getvalue()
+            st.output_file = None
+            return s
+
+        output_time, stubs = self.best_time(output)
+        #
+        # Time the --update merge. Each merge needs a fresh traverser.
+        update_time = None
+        for i in range(self.repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                st = visit()
+                t1 = time.perf_counter()
+                try:
+                    st.update(fn, new_root=st.parent_stub, contents=stubs, silent=True)
+                except Exception:
+                    update_time = None
+                    break
+                t2 = time.perf_counter()
+            if update_time is None or t2 - t1 < update_time:
+                update_time = t2 - t1
+        return {
+            'parse': parse_time,
+            'visit': visit_time - reduce_time,
+            'reduce_types': reduce_time,
+            'update': update_time,
+            'output': output_time,
+        }
+    #@+node:ekr.20261017101004.2: *3* bench.time_dispatch
+    def time_dispatch(self, corpus: Corpus) -> Dict[str, Any]:
+        """
+        Return the cost per ast node, in nanoseconds, of AstFormatter.format
+        and GetattrFormatter.format on the corpus.
+        """
+        n_nodes, t_dict, t_getattr = 0, 0.0, 0.0
+        for fn, source in corpus:
+            tree = ast.parse(source, filename=fn, mode='exec')
+            n_nodes += sum(1 for z in ast.walk(tree))
+            t_dict += self.best_time(lambda: msf.AstFormatter().format(tree))[0]
+            t_getattr += self.best_time(lambda: GetattrFormatter().format(tree))[0]
+        return {
+            'nodes': n_nodes,
+            'ns_per_node': 1e9 * t_dict / n_nodes if n_nodes else 0.0,
+            'getattr_ns_per_node': 1e9 * t_getattr / n_nodes if n_nodes else 0.0,
+        }
+    #@-others
+#@+node:ekr.20261017101004.3: ** class GetattrFormatter (AstFormatter)
+class GetattrFormatter(msf.AstFormatter):
+    """
+    An AstFormatter whose visit method finds the visitor of each node with
+    getattr, as AstFormatter.visit did before it used dispatch_dict.
+    """
+
+    def visit(self, node: Node) -> str:
+        if isinstance(node, (list, tuple)):
+            return ','.join([self.visit(z) for z in node])  # pragma: no cover
+        if node is None:
+            return 'None'  # pragma: no cover
+        method = getattr(self, 'do_' + node.__class__.__name__, None)
+        if method:
+            s = method(node)
+            assert isinstance(s, str), s.__class__.__name__
+            return s
+        return self.visit_other(node)  # pragma: no cover
+#@-others
+
+if __name__ == '__main__':
+    main()  # pragma: no cover
+#@-leo
@@ -20,6 +20,20 @@ documentation.
 --diff: True: print diffs of proposed changes.
         False: hange the input files.
 
+--recursive: Replace each directory in FILES by the .py files in its tree,
+        skipping the directories that make_stub_files --recursive skips.
+        The stub files mirror the layout of the tree in the output
+        directory.
+
+--jobs N: Handle files using a pool of N processes. Output appears in the
+        order of the files, as it does without --jobs.
+
+--benchmark [LINES]: Time the rewriter on a synthetic file of LINES
+        (default 50000) lines, then exit.
+
+With or without --jobs, wax_off reports the error in any file, goes on to
+the next file, and exits with status 1 if any file had errors.
+
 **Tweaking the stub files**
 
 The wax_off script knows little about python: it is just a pattern
@@ -40,102 +54,195 @@ stub file.
 #@+<< imports >>
 #@+node:ekr.20210810171411.1: ** << imports >>
 import argparse
-import difflib
 import glob
+import io
 import os
 import re
 import sys
+import time
+import token
+import tokenize
+try:
+    import make_stub_files as msf
+except ImportError:  # Running from a source tree.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import make_stub_files as msf
 #@-<< imports >>
 
-# Match class definitions.
-class_pat = re.compile(r'^[ ]*class\s+[\w_]+.*?:', re.MULTILINE)
-
-# Match function/method definitions.
-def_pat = re.compile(r'^([ ]*)def\s+([\w_]+)\s*\((.*?)\)(.*?):', re.MULTILINE + re.DOTALL)
-
 __version__ = 'wax_off.py version 0.1'
 
 #@+others
+#@+node:ekr.20261017101009.1: ** functions: worker processes
+# These functions run in the worker processes created by msf.map_files.
+
+g_wax_off = None  # The WaxOff instance in a worker process.
+
+def init_worker(wax_off):
+    """Remember the WaxOff instance in a worker process."""
+    global g_wax_off
+    g_wax_off = wax_off
+
+def do_file_in_worker(input_fn):
+    """Handle one file, using the worker's WaxOff instance."""
+    g_wax_off.do_file(input_fn)
 #@+node:ekr.20210810165920.1: ** class WaxOff
 class WaxOff:
     diff = True
+    jobs = 0
     remove = False
     trace = False
     #@+others
+    #@+node:ekr.20261017101013.3: *3* wax_off.ctor
+    def __init__(self):
+        """Ctor for WaxOff class. scan_options sets these ivars from sys.argv."""
+        self.files = []
+        self.input_directory = os.getcwd()
+        self.output_directory = os.getcwd()
+        self.source_roots = {}  # Keys are files found by --recursive. Values are their roots.
+    #@+node:ekr.20261017101010.3: *3* wax_off.benchmark
+    def benchmark(self, n_lines):
+        """
+        Time the rewriter and the --diff output on a synthetic file of about
+        n_lines lines, containing annotated classes and defs.
+        """
+        lines = ['import os', '']
+        i = 0
+        while len(lines) < n_lines:
+            lines.extend([
+                f"class Class{i}(object):",
+                f"    \"\"\"Class {i}.\"\"\"",
+                f"    def method{i}(self, a: int, b: Dict[str, List[int]]={{'a': [1, 2]}}, c: str='x') -> Optional[str]:",
+                f"        return os.path.join(str(a), c)",
+                f"    def long_method{i}(",
+                f"        self,",
+                f"        a: Callable[[int, str], bool],",
+                f"        b: Tuple[int, ...]=(1, 2),",
+                f"    ) -> Dict[str, int]:",
+                f"        if a(1, 'b'):",
+                f"            return {{'a': b[0]}}",
+                f"        return {{}}",
+                '',
+            ])
+            i += 1
+        contents = '\n'.join(lines) + '\n'
+        t1 = time.perf_counter()
+        stubs, new_contents, changes = self.rewrite(contents)
+        t2 = time.perf_counter()
+        with open(os.devnull, 'w') as f:
+            f.writelines(self.unified_diff(contents, new_contents, changes, 'old', 'new'))
+        t3 = time.perf_counter()
+        print(
+            f"{len(lines)} lines, {len(changes)} defs: "
+            f"rewrite: {t2 - t1:.3f} sec. diff: {t3 - t2:.3f} sec.")
     #@+node:ekr.20210810102041.3: *3* wax_off.do_file
     def do_file(self, input_fn):
         """Handle one file"""
         # Define output files.
-        short_input_fn = os.path.basename(input_fn)
-        stub_fn = os.path.join(self.output_directory, short_input_fn + 'i')
-        new_fn = os.path.join(self.output_directory, short_input_fn)
+        root = self.source_roots.get(input_fn)
+        if root:
+            # Mirror the layout of root's tree in the output directory.
+            new_fn = os.path.join(self.output_directory, os.path.relpath(input_fn, root))
+            os.makedirs(os.path.dirname(new_fn), exist_ok=True)
+        else:
+            new_fn = os.path.join(self.output_directory, os.path.basename(input_fn))
+        stub_fn = new_fn + 'i'
         # Read the input file.
         with open(input_fn, 'r') as f:
             contents = f.read()
-        # Find all the class defs.
-        n = 0
-        file_stubs, replacements = [], []
-        for m in class_pat.finditer(contents):
-            class_stub = m.group(0).rstrip() + '\n'
-            file_stubs.append((m.start(), class_stub))
-        # Find all the defs.
-        for m in def_pat.finditer(contents):
-            n += 1
-            stub = f"{m.group(0)} ...\n"
-            lws = m.group(1)
-            name = m.group(2)
-            args = self.stripped_args(m.group(3))
-            # ret = m.group(4)
-            stripped = f"{lws}def {name}({args}):"
-            assert not stripped.startswith('\n'), stripped
-            if 0:
-                print(f"{n:>3} original: {m.group(0).rstrip()}")
-                print(f"{n:>3}     stub: {stub.rstrip()}")
-                print(f"{n:>3} stripped: {stripped}")
-                print('')
-            # Append the results.
-            replacements.append((m.start(), m.group(0), stripped))
-            file_stubs.append((m.start(), stub))
-        # Dump the replacements:
-        if 0:
-            for i, data in enumerate(replacements):
-                start, old, new = data
-                print(i, start)
-                print(f"{old!r}")
-                print(f"{new!r}")
-        # Sort the stubs.
-        file_stubs.sort()
-        # Dump the sorted stubs.
-        if 0:
-            for data in file_stubs:
-                start, s = data
-                print(s.rstrip())
+        try:
+            stubs, new_contents, changes = self.rewrite(contents)
+        except (SyntaxError, tokenize.TokenError) as e:
+            print(f"\nCan not tokenize {input_fn}: {e}")
+            return
         # Write the stub file.
         print(f"\nWriting {stub_fn}")
         with open(stub_fn, 'w') as f:
-            f.write(''.join(z[1] for z in file_stubs))
-        # Compute the new contents.
-        new_contents = contents
-        for data in reversed(replacements):
-            start, old, new = data
-            assert new_contents[start:].startswith(old), (start, old, new_contents[start:start+50])
-            new_contents = new_contents[:start] + new + new_contents[start+len(old):]
+            f.write(stubs)
         # --diff.
         if self.diff:  # Diff the old and new contents.
-            lines = list(difflib.unified_diff(
-                contents.splitlines(True), new_contents.splitlines(True),
-                fromfile=input_fn, tofile=new_fn, n=0))
             print(f"Diff: {new_fn}")
-            for line in lines:
-                print(repr(line))
+            for line in self.unified_diff(contents, new_contents, changes, input_fn, new_fn):
+                sys.stdout.write(line if line.endswith('\n') else line + '\n')
         # --remove.
         if self.remove:  # Write the new file.
             print(f"Writing: {new_fn}")
             with open(new_fn, 'w') as f:
                 f.write(new_contents)
-        print(f"{len(replacements)} replacements")
+        print(f"{len(changes)} replacements")
+    #@+node:ekr.20261017101013.4: *3* wax_off.do_files
+    def do_files(self):
+        """
+        Handle all files in self.files, using self.jobs worker processes.
+
+        With or without --jobs, report the error in any file and go on to
+        the next. Return the number of files with errors.
+        """
+        errors = 0
+        for fn, output, elapsed, error, result in msf.map_files(
+            do_file_in_worker, self.files, self.jobs,
+            initializer=init_worker, initargs=(self,),
+        ):
+            print(output, end='')
+            if error:
+                errors += 1
+                print(f"error: {fn}\n{error}", end='')
+        return errors
+    #@+node:ekr.20261017101010.1: *3* wax_off.find_signatures
+    def find_signatures(self, contents):
+        """
+        Tokenize contents once, and return a list of tuples
+        (kind, row, start, end, lws, name, args), in source order, for each
+        class and def statement:
+
+        - kind:  'class' or 'def'.
+        - row:   the (zero-based) number of the line containing the keyword.
+        - start: the offset of that line.
+        - end:   the offset following the ':' that ends the signature.
+        - lws:   the text between start and the keyword.
+        - name:  the name of the class or def.
+        - args:  the argument list of a def, without parens, or None.
+        """
+        offsets = [0]  # The offsets of the lines of contents.
+        for line in contents.split('\n'):
+            offsets.append(offsets[-1] + len(line) + 1)
+
+        def offset(position):
+            row, col = position
+            return offsets[row - 1] + col
+
+        result = []
+        at_line_start = True  # True if the next token starts a logical line.
+        tokens = tokenize.generate_tokens(io.StringIO(contents).readline)
+        for tok in tokens:
+            if at_line_start and tok.type == token.NAME and tok.string in ('class', 'def'):
+                kind, keyword = tok.string, offset(tok.start)
+                row = tok.start[0] - 1
+                start = offsets[row]
+                name = next(tokens).string
+                args, level = None, 0
+                # Scan to the ':' at level 0, remembering the def's argument list.
+                for tok in tokens:
+                    if tok.type != token.OP:
+                        continue
+                    if tok.string in ('(', '[', '{'):
+                        if level == 0 and tok.string == '(' and kind == 'def' and args is None:
+                            args_start = offset(tok.end)
+                        level += 1
+                    elif tok.string in (')', ']', '}'):
+                        level -= 1
+                        if level == 0 and tok.string == ')' and kind == 'def' and args is None:
+                            args = contents[args_start : offset(tok.start)]
+                    elif tok.string == ':' and level == 0:
+                        break
+                lws = contents[start:keyword]
+                result.append((kind, row, start, offset(tok.end), lws, name, args))
+                at_line_start = False
+            elif tok.type not in (token.COMMENT, token.NL):
+                at_line_start = tok.type in (token.DEDENT, token.INDENT, token.NEWLINE)
+        return result
     #@+node:ekr.20210810102041.4: *3* wax_off.get_next_arg
-    name_pat = re.compile(r'\s*([\w_]+)\s*')
+    # A name, *args, **kwargs, or a bare '*' or '/'.
+    name_pat = re.compile(r'\s*(\*\*\w+|\*\w*|/|\w+)\s*')
 
     def get_next_arg(self, s, i):
         """
@@ -178,9 +285,36 @@ class WaxOff:
         # Handle command-line options & set ivars.
         self.scan_options()
         # Handle each file.
-        for fn in self.files:
-            path = os.path.join(self.input_directory, fn)
-            self.do_file(path)
+        if self.do_files():
+            sys.exit(1)
+    #@+node:ekr.20261017101010.2: *3* wax_off.rewrite
+    def rewrite(self, contents):
+        """
+        Return (stubs, new_contents, changes) for contents, the contents of
+        a file:
+
+        - stubs:        the contents of the stub file.
+        - new_contents: contents with the annotations of all defs removed.
+        - changes:      a list of tuples (row, n), one for each def. The
+                        def's signature replaces the n lines of contents
+                        starting at row with a single line.
+
+        Both results are built with a single join, in time linear in
+        len(contents).
+        """
+        stubs, pieces, changes, i = [], [], [], 0
+        for kind, row, start, end, lws, name, args in self.find_signatures(contents):
+            signature = contents[start:end]
+            if kind == 'class':
+                stubs.append(signature.rstrip() + '\n')
+                continue
+            stubs.append(f"{signature} ...\n")
+            pieces.append(contents[i:start])
+            pieces.append(f"{lws}def {name}({self.stripped_args(args or '')}):")
+            changes.append((row, signature.count('\n') + 1))
+            i = end
+        pieces.append(contents[i:])
+        return ''.join(stubs), ''.join(pieces), changes
     #@+node:ekr.20210810102041.6: *3* wax_off.scan_options
     def scan_options(self):
         """Run commands specified by sys.argv."""
@@ -195,9 +329,17 @@ class WaxOff:
             description="wax_off.py: create stub files, then remove function annotations")
         add = parser.add_argument
         add('FILES', nargs='*', help='list of files or directories')
+        add('--benchmark', dest='benchmark', metavar='LINES', type=int, nargs='?', const=50000,
+            help='time the rewriter on a synthetic file of LINES (default 50000) lines and exit')
         add('-d', '--diff', dest='d', action='store_true', help='Show diff without writing files')
+        add('--exclude', dest='excludes', metavar='PATTERN', action='append', default=[],
+            help='--recursive: skip files and directories matching PATTERN')
         add('-i', '--input-directory', dest='i_dir', metavar="DIR", type=dir_path, help='Input directory')
+        add('-j', '--jobs', dest='jobs', metavar='N', type=int, default=0,
+            help='handle files using N worker processes')
         add('-o', '--output-directory', dest='o_dir', metavar="DIR", type=dir_path, help='Output directory')
+        add('--recursive', dest='recursive', action='store_true',
+            help='handle the .py files in the trees of directories in FILES')
         add('-r', '--remove', dest='r', action='store_true', help='Remove annotations')
         add('-t', '--trace', dest='t', action='store_true', help='Show debug traces')
         add('-v', '--version', dest='v', action='store_true', help='show version and exit')
@@ -206,8 +348,12 @@ class WaxOff:
         if args.v:
             print(__version__)
             sys.exit(0)
+        if args.benchmark:
+            self.benchmark(args.benchmark)
+            sys.exit(0)
         # Set flags.
         self.diff = bool(args.d)
+        self.jobs = max(0, args.jobs)
         self.remove = bool(args.r)
         self.trace = bool(args.t)
         # Compute directories. They are known to exist.
@@ -215,9 +361,17 @@ class WaxOff:
         self.output_directory = args.o_dir or os.getcwd()
         # Get files.
         files = []
+        excludes = list(msf.default_excludes) + args.excludes
+        self.source_roots = {}
         for fn in args.FILES:
             path = os.path.join(self.input_directory, fn)
-            files.extend(glob.glob(path))
+            for path2 in glob.glob(path):
+                if args.recursive and os.path.isdir(path2):
+                    for path3 in msf.find_source_files(path2, excludes):
+                        self.source_roots[path3] = path2
+                        files.append(path3)
+                else:
+                    files.append(path2)
         # Warn if files do not exist.
         self.files = []
         for path in files:
@@ -325,6 +479,48 @@ class WaxOff:
             args.append(arg)
             assert progress < i, (i, repr(s[i:]))
         return ', '.join(args)
+    #@+node:ekr.20261017101010.4: *3* wax_off.unified_diff
+    def unified_diff(self, contents, new_contents, changes, fromfile, tofile):
+        """
+        Yield the lines of the unified diff, without context lines, of
+        contents and new_contents, as computed by rewrite.
+
+        The changes are already known, so the time is linear in the size of
+        the files. Each hunk is a run of adjacent changed lines. The format
+        is that of difflib.unified_diff(n=0), but the hunks may differ:
+        difflib never matches lines that it treats as junk, such as blank
+        lines in large files, so it may merge hunks that such lines separate.
+        """
+        old_lines = io.StringIO(contents).readlines()
+        new_lines = io.StringIO(new_contents).readlines()
+        hunks = []  # Lists [old_start, old_end, new_start, new_end].
+        delta = 0  # The row in new_lines minus the row in old_lines.
+        for row, n in changes:
+            new_row = row + delta
+            delta -= n - 1
+            if old_lines[row : row + n] == new_lines[new_row : new_row + 1]:
+                continue  # The def has no annotations.
+            if hunks and hunks[-1][1] == row:
+                hunks[-1][1], hunks[-1][3] = row + n, new_row + 1
+            else:
+                hunks.append([row, row + n, new_row, new_row + 1])
+        if not hunks:
+            return
+
+        def format_range(start, end):
+            # Like difflib._format_range_unified.
+            if end - start == 1:
+                return f"{start + 1}"
+            return f"{start + 1 if end > start else start},{end - start}"
+
+        yield f"--- {fromfile}\n"
+        yield f"+++ {tofile}\n"
+        for old_start, old_end, new_start, new_end in hunks:
+            yield f"@@ -{format_range(old_start, old_end)} +{format_range(new_start, new_end)} @@\n"
+            for line in old_lines[old_start:old_end]:
+                yield '-' + line
+            for line in new_lines[new_start:new_end]:
+                yield '+' + line
     #@-others
 #@-others
     